@@ -32,15 +32,11 @@ Please visit https://github.com/rettenbs/mailman-ldap-memberadaptor
 for details.
 """
 
-# Not sure why we need to do this to find ldap
-try:
-	import ldap
-except ImportError:
-	import sys
-	sys.path.append('/usr/lib/python2.7/dist-packages')
-	import ldap
-import ldap.modlist
-
+from array import array
+from bisect import bisect_left
+import marshal
+import os
+import threading
 import time
 from types import StringType
 
@@ -48,158 +44,1698 @@ from Mailman import mm_cfg
 from Mailman import Utils
 from Mailman import Errors
 from Mailman import MemberAdaptor
+from Mailman import LockFile
 from Mailman.Logging.Syslog import syslog
 
 DEBUG = False
 
+# Maximum number of batched member searches kept in flight at once
+BATCH_WINDOW = 16
+
+# Maximum number of base reads of member DNs kept in flight at once
+READ_WINDOW = 64
+
+# LDAP_MATCHING_RULE_IN_CHAIN of Active Directory
+IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+# On-disk snapshot format version, and how long the process refreshing
+# the snapshot may hold its lock
+SNAPSHOT_VERSION = 3
+SNAPSHOT_LOCK_LIFETIME = 300
+
+# The MemberAdaptor methods reported to ldaptimer
+TIMED_METHODS = (
+    'getMembers', 'getRegularMemberKeys', 'getDigestMemberKeys', 'isMember',
+    'getMemberKey', 'getMemberCPAddress', 'getMemberCPAddresses',
+    'getMemberPassword', 'authenticateMember', 'getMemberLanguage',
+    'getMemberOption', 'getMemberName', 'getMemberTopics',
+    'getDeliveryStatus', 'getDeliveryStatusChangeTime',
+    'getDeliveryStatusMembers', 'getBouncingMembers', 'getBounceInfo',
+    'addNewMember', 'removeMember', 'changeMemberAddress',
+    'setMemberPassword', 'setMemberLanguage', 'setMemberOption',
+    'setMemberName', 'setMemberTopics', 'setDeliveryStatus', 'setBounceInfo',
+    )
+
+
+class _LazyLdap:
+    """Stands in for the ldap module until it is first used.
+
+    extend.py runs for every CGI request and bin/ script, most of which
+    never look at the members, so python-ldap is only imported by the
+    first lookup of one of its names.  The module then takes our place.
+    """
+    def __getattr__(self, name):
+        global ldap
+        try:
+            import ldap as module
+        except ImportError:
+            # Not sure why we need to do this to find ldap
+            import sys
+            sys.path.append('/usr/lib/python2.7/dist-packages')
+            import ldap as module
+        for submodule in ('ldap.controls', 'ldap.filter'):
+            __import__(submodule)
+        ldap = module
+        return getattr(module, name)
+
+ldap = _LazyLdap()
+
+
+def _intern(value):
+    """Intern a DN or address, so that it is held once however many
+    snapshots and lists refer to it"""
+    if type(value) is str:
+        return intern(value)
+    return value
+
+def _get_values(attrs, name):
+    """Return the values of attribute name, whatever case the server used"""
+    values = attrs.get(name)
+    if values is not None:
+        return values
+    name = name.lower()
+    for (key, values) in attrs.iteritems():
+        if key.lower() == name:
+            return values
+    return ()
+
+def _normalize_dn(dn):
+    return ','.join([rdn.strip() for rdn in dn.lower().split(',')])
+
+def _normalize_address(value):
+    """Return an address value lowercased, None if it is not an e-mail
+    address.
+
+    Active Directory's proxyAddresses prefix each value with its type,
+    SMTP: for the primary address, smtp: for the others and X500:, SIP:
+    and so on for other kinds of address.
+    """
+    value = value.strip().lower()
+    if ':' in value.split('@', 1)[0]:
+        (kind, value) = value.split(':', 1)
+        if kind != 'smtp':
+            return None
+    return value
+
+def _decode_name(name):
+    """Full names are kept UTF-8 encoded, return name as unicode"""
+    if type(name) is str:
+        return name.decode('utf8')
+    return name
+
+def _fold(text):
+    """Lowercase text, str or unicode, and return it UTF-8 encoded"""
+    if type(text) is str:
+        try:
+            text = text.decode('utf8')
+        except UnicodeError:
+            return text.lower()
+    return text.lower().encode('utf8')
+
+def _excluded(attrs, gid):
+    """True if a destinationindicator value of the entry lists gid"""
+    for value in _get_values(attrs, 'destinationindicator'):
+        if gid in value.split(','):
+            return True
+    return False
+
+
+
+class _Snapshot:
+    """The members loaded by one refresh.
+
+    A refresh fills a new snapshot and then replaces the current one with a
+    single assignment, so readers never see a half loaded member list.
+
+    The maps are keyed by the interned DNs, which regular and digest hold
+    anyway.  Columns indexed by a member number would need a DN to number
+    dict and an int object per member on top, more than the dicts they
+    replace save (see the snapshot per member of bench_adaptor.py).
+    """
+    # Attributes stored in the on-disk snapshot
+    _persistent = ('regular', 'digest', 'member_map', 'names', 'moderators',
+                   'uids', 'indicators', 'updatetime', 'fullupdatetime',
+                   'watermark', 'watermark_dns')
+
+    def __init__(self):
+        self.regular = {}
+        self.digest = {}
+        self.member_map = {}
+        # UTF-8 encoded, see name()
+        self.names = {}
+        self.moderators = {}
+
+        # Lowercased ldapmemberuid value -> member, and the gids in the
+        # destinationindicator of the members having one, kept to resolve
+        # the moderator group locally
+        self.uids = {}
+        self.indicators = {}
+
+        self.updatetime = time.time()
+        self.fullupdatetime = self.updatetime
+
+        # Highest ldapwatermarkattr value seen, and the entries carrying it
+        self.watermark = None
+        self.watermark_dns = set()
+
+        # Lowercased (all, regular, digest) addresses, see memberlists()
+        self.__memberlists = None
+        self.__roster = None
+
+    def memberlists(self):
+        """Return the lowercased member addresses as three tuples.
+
+        They are built on first use and then kept until the snapshot is
+        changed, getMembers() and friends are called in loops.
+        """
+        lists = self.__memberlists
+        if lists is None:
+            # Interned, they are the keys of member_map.  Two entries with
+            # the same mail are one member, a regular one if either is.
+            seen = set()
+            lists = ([], [])
+            for (members, addrs) in ((self.regular, lists[0]),
+                                     (self.digest, lists[1])):
+                for addr in members.itervalues():
+                    addr = _intern(addr.lower())
+                    if addr not in seen:
+                        seen.add(addr)
+                        addrs.append(addr)
+            regular = tuple(lists[0])
+            digest = tuple(lists[1])
+            lists = self.__memberlists = (regular + digest, regular, digest)
+        return lists
+
+    def roster(self):
+        """Return the _Roster of the members, built on first use"""
+        roster = self.__roster
+        if roster is None:
+            roster = self.__roster = _Roster(self)
+        return roster
+
+    def changed(self):
+        """Must be called after modifying the member maps in place"""
+        self.__memberlists = None
+        self.__roster = None
+
+    def name(self, dn):
+        """Return the full name of member dn as unicode, or None"""
+        return _decode_name(self.names.get(dn))
+
+    def size(self):
+        """Return the number of bytes of member strings held"""
+        size = 0
+        for members in (self.regular, self.digest):
+            for (dn, addr) in members.iteritems():
+                size += len(dn) + len(addr)
+        for name in self.names.itervalues():
+            size += len(name)
+        for addr in self.member_map.iterkeys():
+            size += len(addr)
+        return size
+
+    def copy(self):
+        snap = _Snapshot()
+        snap.regular = self.regular.copy()
+        snap.digest = self.digest.copy()
+        snap.member_map = self.member_map.copy()
+        snap.names = self.names.copy()
+        snap.moderators = self.moderators.copy()
+        snap.uids = self.uids.copy()
+        snap.indicators = self.indicators.copy()
+        snap.fullupdatetime = self.fullupdatetime
+        snap.watermark = self.watermark
+        snap.watermark_dns = set(self.watermark_dns)
+        return snap
+
+    def dump(self, fp, config):
+        data = {'version': SNAPSHOT_VERSION, 'config': config}
+        for attr in self._persistent:
+            data[attr] = getattr(self, attr)
+        marshal.dump(data, fp)
+
+    def load(self, fp, config):
+        """Fill the snapshot from fp, return False if it does not fit"""
+        data = marshal.load(fp)
+        if data.get('version') != SNAPSHOT_VERSION or data.get('config') != config:
+            return False
+        for attr in self._persistent:
+            setattr(self, attr, data[attr])
+        self.changed()
+        return True
+
+    def remove(self, dns):
+        for dn in dns:
+            self.regular.pop(dn, None)
+            self.digest.pop(dn, None)
+            self.names.pop(dn, None)
+            self.moderators.pop(dn, None)
+            self.indicators.pop(dn, None)
+        for (maddr, dn) in self.member_map.items():
+            if dn in dns:
+                del self.member_map[maddr]
+        for (uid, dn) in self.uids.items():
+            if dn in dns:
+                del self.uids[uid]
+        self.changed()
+
+    def forget_addresses(self, dns):
+        """Drop the addresses of members dns from member_map, before they
+        are loaded again"""
+        for (maddr, dn) in self.member_map.items():
+            if dn in dns:
+                del self.member_map[maddr]
+        self.changed()
+
+
+
+class _Roster:
+    """The members of a snapshot sorted for the admin pages.
+
+    addresses holds the lowercased member addresses in order and dns their
+    entries; buckets maps a first letter to the (start, end) positions of
+    the addresses starting with it.  Searches go through an index of the
+    three letter substrings of the addresses and full names, built by the
+    first search, so they cost the members sharing the rarest substring of
+    the text instead of the whole list.
+    """
+    def __init__(self, snap):
+        pairs = []
+        for members in (snap.regular, snap.digest):
+            for (dn, addr) in members.iteritems():
+                pairs.append((_intern(addr.lower()), dn))
+        pairs.sort()
+        self.addresses = tuple([addr for (addr, dn) in pairs])
+        self.dns = tuple([dn for (addr, dn) in pairs])
+        self.buckets = {}
+        for i in xrange(len(self.addresses)):
+            letter = self.addresses[i][:1]
+            if letter in self.buckets:
+                self.buckets[letter] = (self.buckets[letter][0], i + 1)
+            else:
+                self.buckets[letter] = (i, i + 1)
+        self.__names = snap.names
+        # Folded 'address\nfull name' per position, and trigram -> positions
+        self.__texts = None
+        self.__trigrams = None
+
+    def row(self, i):
+        """Return (address, full name) of position i"""
+        return (self.addresses[i], _decode_name(self.__names.get(self.dns[i])))
+
+    def __index(self):
+        texts = []
+        trigrams = {}
+        for i in xrange(len(self.addresses)):
+            fields = [self.addresses[i]]
+            name = self.__names.get(self.dns[i])
+            if name:
+                fields.append(_fold(name))
+            grams = set()
+            for field in fields:
+                for k in xrange(len(field) - 2):
+                    grams.add(field[k:k + 3])
+            for gram in grams:
+                positions = trigrams.get(gram)
+                if positions is None:
+                    positions = trigrams[gram] = array('i')
+                positions.append(i)
+            texts.append('\n'.join(fields))
+        self.__texts = texts
+        self.__trigrams = trigrams
+
+    def search(self, text):
+        """Return the positions, in order, of the members whose address or
+        full name contains text, ignoring case"""
+        text = _fold(text)
+        if self.__texts is None:
+            self.__index()
+        texts = self.__texts
+        if len(text) < 3:
+            return [i for i in xrange(len(texts)) if text in texts[i]]
+        candidates = None
+        for k in xrange(len(text) - 2):
+            positions = self.__trigrams.get(text[k:k + 3])
+            if positions is None:
+                return []
+            if candidates is None or len(positions) < len(candidates):
+                candidates = positions
+        return [i for i in candidates if text in texts[i]]
+
+
+
+#
+# Client side LDAP filter evaluation (RFC 4515) for the shared directory
+# cache.  Values are compared case insensitively, which is what the usual
+# member selection attributes (objectClass, mail, uid, ...) do on the
+# server.  Extensible matches are not supported.
+#
+def _unescape_filter_value(value):
+    parts = value.split('\\')
+    result = [parts[0]]
+    for part in parts[1:]:
+        result.append(chr(int(part[:2], 16)) + part[2:])
+    return ''.join(result)
+
+def _parse_filter(filterstr, pos=0):
+    """Return (node, end) for the filter component starting at pos"""
+    if not filterstr.startswith('(', pos):
+        if pos == 0:
+            return _parse_filter('(' + filterstr + ')')
+        raise ValueError('bad filter %r' % filterstr)
+    op = filterstr[pos + 1]
+    if op in '&|':
+        subs = []
+        pos += 2
+        while filterstr.startswith('(', pos):
+            (node, pos) = _parse_filter(filterstr, pos)
+            subs.append(node)
+        if not filterstr.startswith(')', pos):
+            raise ValueError('bad filter %r' % filterstr)
+        return ((op, subs), pos + 1)
+    if op == '!':
+        (node, pos) = _parse_filter(filterstr, pos + 2)
+        if not filterstr.startswith(')', pos):
+            raise ValueError('bad filter %r' % filterstr)
+        return (('!', node), pos + 1)
+    end = filterstr.find(')', pos)
+    if end < 0:
+        raise ValueError('bad filter %r' % filterstr)
+    item = filterstr[pos + 1:end]
+    eq = item.find('=')
+    if eq <= 0:
+        raise ValueError('bad filter %r' % filterstr)
+    attr = item[:eq]
+    value = item[eq + 1:]
+    if attr[-1] in '<>~':
+        (attr, op) = (attr[:-1], attr[-1])
+    else:
+        op = '='
+    if ':' in attr:
+        raise ValueError('extensible match not supported: %r' % filterstr)
+    attr = attr.strip().lower()
+    if op == '=' and value == '*':
+        return (('*', attr), end + 1)
+    if op == '=' and '*' in value:
+        parts = [_unescape_filter_value(part).lower() for part in value.split('*')]
+        return (('sub', attr, parts), end + 1)
+    return ((op, attr, _unescape_filter_value(value).lower()), end + 1)
+
+def _filter_attrs(node, attrs=None):
+    """Return the set of attribute names used by a parsed filter"""
+    if attrs is None:
+        attrs = set()
+    if node[0] in '&|':
+        for sub in node[1]:
+            _filter_attrs(sub, attrs)
+    elif node[0] == '!':
+        _filter_attrs(node[1], attrs)
+    else:
+        attrs.add(node[1])
+    return attrs
+
+def _filter_match(node, lattrs):
+    """Match a parsed filter against attributes keyed by lowercased name"""
+    op = node[0]
+    if op == '&':
+        for sub in node[1]:
+            if not _filter_match(sub, lattrs):
+                return False
+        return True
+    if op == '|':
+        for sub in node[1]:
+            if _filter_match(sub, lattrs):
+                return True
+        return False
+    if op == '!':
+        return not _filter_match(node[1], lattrs)
+    values = lattrs.get(node[1], ())
+    if op == '*':
+        return bool(values) or node[1] == 'objectclass'
+    if op == 'sub':
+        parts = node[2]
+        for value in values:
+            value = value.lower()
+            if not value.startswith(parts[0]):
+                continue
+            pos = len(parts[0])
+            for part in parts[1:-1]:
+                pos = value.find(part, pos)
+                if pos < 0:
+                    break
+                pos += len(part)
+            else:
+                if (len(value) - pos >= len(parts[-1])
+                    and value.endswith(parts[-1])):
+                    return True
+        return False
+    wanted = node[2]
+    for value in values:
+        value = value.lower()
+        if op in '=~':
+            if value == wanted:
+                return True
+            continue
+        if value.isdigit() and wanted.isdigit():
+            (value, other) = (int(value), int(wanted))
+        else:
+            other = wanted
+        if (op == '>' and value >= other) or (op == '<' and value <= other):
+            return True
+    return False
+
+
+class _DirectoryCache:
+    """Person entries of one directory, shared by all lists of a process.
+
+    Entries are kept as (dn, attrs, lattrs) with lattrs keyed by the
+    lowercased attribute name.  A cache is never modified after load(), a
+    reload replaces it in _directory_caches.
+    """
+    def __init__(self, attrs, entries):
+        self.attrs = attrs
+        self.loadtime = time.time()
+        self.entries = [(dn, entry, dict([(name.lower(), values)
+                                          for (name, values) in entry.items()]))
+                        for (dn, entry) in entries]
+        self.__indexes = {}
+
+    def fresh(self, attrs, ttl):
+        return attrs <= self.attrs and self.loadtime + ttl >= time.time()
+
+    def index(self, attr):
+        """Return a map of lowercased attr value to entries"""
+        attr = attr.lower()
+        index = self.__indexes.get(attr)
+        if index is None:
+            index = {}
+            for entry in self.entries:
+                values = entry[2].get(attr)
+                if values is None and attr == 'distinguishedname':
+                    values = [entry[0]]
+                for value in values or ():
+                    index.setdefault(value.lower(), []).append(entry)
+            self.__indexes[attr] = index
+        return index
+
+    def search(self, node):
+        return [(dn, entry) for (dn, entry, lattrs) in self.entries
+                if _filter_match(node, lattrs)]
+
+# (ldapserver, ldapbasedn, ldapsharedfilter) -> _DirectoryCache, and the
+# locks that make only one list at a time reload a directory
+_directory_caches = {}
+_directory_locks = {}
+_directory_lock = threading.Lock()
+
+# (ldapserver, group dn) -> (gidNumber, time read)
+_group_gids = {}
+
+
+
+#
+# Connections
+#
+# Index of the server that answered last, per server list
+_preferred_server = {}
+
+def _ldap_connect(servers, binddn, passwd, tls, connecttimeout, timeout):
+    """Bind to the first reachable server.
+
+    The server that worked last time is tried first, then the others in
+    their configured order.
+    """
+    if not servers:
+        raise ValueError('ldapserver does not name an LDAP server')
+    first = _preferred_server.get(servers, 0)
+    error = None
+    for i in range(len(servers)):
+        index = (first + i) % len(servers)
+        try:
+            l = ldap.initialize(servers[index])
+            l.set_option(ldap.OPT_NETWORK_TIMEOUT, connecttimeout)
+            l.set_option(ldap.OPT_TIMEOUT, timeout)
+            if tls:
+                l.start_tls_s()
+            l.simple_bind_s(binddn, passwd)
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT), e:
+            syslog('warn', 'LDAP server %s unreachable: %s' % (servers[index], e))
+            error = e
+            continue
+        _preferred_server[servers] = index
+        return l
+    raise error
+
+def _abandon(l, msgids):
+    """Abandon the operations msgids, so their results do not pile up on
+    a connection that is used again"""
+    for msgid in msgids:
+        try:
+            l.abandon(msgid)
+        except ldap.LDAPError:
+            pass
+
+
+class _ConnectionPool:
+    """Bound connections for worker threads.
+
+    At most size connections are handed out at once, get() blocks when
+    they are all in use.
+    """
+    def __init__(self, connect, size):
+        self.__connect = connect
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__slots = threading.Semaphore(size)
+
+    def get(self):
+        self.__slots.acquire()
+        self.__lock.acquire()
+        try:
+            if self.__idle:
+                return self.__idle.pop()
+        finally:
+            self.__lock.release()
+        try:
+            return self.__connect()
+        except:
+            self.__slots.release()
+            raise
+
+    def put(self, l):
+        self.__lock.acquire()
+        try:
+            self.__idle.append(l)
+        finally:
+            self.__lock.release()
+        self.__slots.release()
+
+    def discard(self, l):
+        """Return a broken connection, it is closed instead of reused"""
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+        self.__slots.release()
+
+# Connection settings -> _ConnectionPool
+_connection_pools = {}
+_connection_lock = threading.Lock()
+
+
+class _CircuitBreaker:
+    """Failed member loads from a directory.
+
+    After a failure the directory is left alone for a delay that doubles
+    with every further failure, and the lists keep their last snapshot.
+    When the delay is over one caller may try again, the others keep
+    waiting until it succeeds or fails.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.error = None
+        self.__retry = 0
+        self.__delay = 0
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """True if the directory may be used now"""
+        self.__lock.acquire()
+        try:
+            now = time.time()
+            if now < self.__retry:
+                return False
+            if self.failures:
+                self.__retry = now + self.__delay
+            return True
+        finally:
+            self.__lock.release()
+
+    def failure(self, error, backoff, maxbackoff):
+        """Record a failed load, return the seconds until the next try"""
+        self.__lock.acquire()
+        try:
+            self.failures += 1
+            self.error = error
+            self.__delay = min(backoff * 2 ** (self.failures - 1), maxbackoff)
+            self.__retry = time.time() + self.__delay
+            return self.__delay
+        finally:
+            self.__lock.release()
+
+    def success(self):
+        self.__lock.acquire()
+        try:
+            self.failures = 0
+            self.error = None
+            self.__retry = self.__delay = 0
+        finally:
+            self.__lock.release()
+
+# ldapserver -> _CircuitBreaker for the errors of unreachable servers,
+# shared by the lists
+_breakers = {}
+
 
 
 class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
     def __init__(self, mlist):
         self.__mlist = mlist
 
-        self.__updatetime = 0
         self.__ldap_conn = None
-
-        self.__regularmembers = None
-        self.__digestmembers = None
-        self.__member_map = {}
-        self.__member_names = {}
-        self.__mod_members = {}
+        self.__snapshot = None
+        # mtime of the on-disk snapshot we read last
+        self.__snapshot_mtime = None
+        # Snapshot the old style storage was last synchronized with
+        self.__synced = None
+        # Failed refreshes of this list, see __breaker() for the server
+        self.__failures = _CircuitBreaker()
+
+        # Counters reported by stats()
+        self.__stats = {'refreshes': 0, 'refresh_failures': 0, 'stale_served': 0,
+                        'refresh_seconds': 0.0, 'last_refresh_seconds': 0.0,
+                        'searches': 0, 'entries': 0, 'member_bytes': 0,
+                        'snapshot_hits': 0, 'snapshot_file_loads': 0,
+                        'saves': 0, 'lookup_hits': 0, 'lookup_misses': 0}
+        self.__stats_logged = time.time()
+        # Held while a refresh is running, so only one runs at a time
+        self.__refresh_lock = threading.Lock()
 
 
     #
     # LDAP utility functions
     #
+    def __ldap_servers(self):
+        # ldapserver is one URI, several separated by spaces, or a list
+        if isinstance(self.ldapserver, StringType):
+            return tuple(self.ldapserver.split())
+        return tuple(self.ldapserver)
+
+    def __ldap_settings(self):
+        return (self.__ldap_servers(), self.ldapbinddn, self.ldappasswd,
+                self.ldaptls, self.ldapconnecttimeout, self.ldaptimeout)
+
+    def __ldap_connect(self):
+        return _ldap_connect(*self.__ldap_settings())
+
     def __ldap_bind(self):
         if not self.__ldap_conn:
-            l = ldap.initialize(self.ldapserver)
-            if self.ldaptls:
-                l.start_tls_s()
-            l.simple_bind_s(self.ldapbinddn, self.ldappasswd)
-            self.__ldap_conn = l
+            self.__ldap_conn = self.__ldap_connect()
         return self.__ldap_conn
 
-    def __loadmembers(self, result, moderator=False):
+    def __ldap_pool(self):
+        settings = self.__ldap_settings()
+        _connection_lock.acquire()
+        try:
+            pool = _connection_pools.get(settings)
+            if pool is None:
+                pool = _connection_pools[settings] = _ConnectionPool(
+                    lambda: _ldap_connect(*settings), self.ldappoolsize)
+            return pool
+        finally:
+            _connection_lock.release()
+
+    def __ldap_call(self, func, *args):
+        """Return func(l, *args) for the request path connection l.
+
+        If the server of a connection kept from an earlier call went away,
+        the call is repeated once on a new connection, which may be to
+        another of the configured servers.  A new connection is not
+        retried, _ldap_connect() has tried every server already.
+        """
+        reused = self.__ldap_conn is not None
+        l = self.__ldap_bind()
+        try:
+            return func(l, *args)
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT), e:
+            self.__ldap_conn = None
+            if not reused:
+                raise
+            syslog('warn', 'Lost LDAP connection for %s, reconnecting: %s'
+                   % (self.__mlist.internal_name(), e))
+            return func(self.__ldap_bind(), *args)
+
+    def __ldap_call_pooled(self, func, *args):
+        """Like __ldap_call(), but with a connection from the pool"""
+        pool = self.__ldap_pool()
+        for retry in (True, False):
+            l = pool.get()
+            try:
+                result = func(l, *args)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT), e:
+                pool.discard(l)
+                if not retry:
+                    raise
+                syslog('warn', 'Lost LDAP connection for %s, reconnecting: %s'
+                       % (self.__mlist.internal_name(), e))
+                continue
+            except:
+                pool.put(l)
+                raise
+            pool.put(l)
+            return result
+
+    def __loadmembers(self, result, snap):
         for (dn, attrs) in result:
             if 'mail' in attrs:
-                mail = attrs['mail'][0].strip()
-                if moderator:
-                    self.__mod_members[dn] = True
-                else:
-                    if dn in self.__mlist.digest_members or not self.__mlist.nondigestable:
-                        self.__digestmembers[dn] = mail
-                    else:
-                        self.__regularmembers[dn] = mail
-                    if DEBUG:
-                        syslog('debug','adding members[lce] = %s' % mail)
-                    # mail can have multiple values -- the_olo
-                    for maddr in attrs['mail']:
-                        self.__member_map[maddr.strip().lower()] = dn
-                    if self.ldapfullname and attrs.has_key(self.ldapfullname):
-                        # set full name if defined
-                        fullname = attrs[self.ldapfullname][0].decode('utf8')
-                        self.__member_names[dn] = fullname
-
-    def __ldap_load_members(self, l=None):
-        if ( (self.__regularmembers is None)
-            or (self.__digestmembers is None)
-            or (self.__updatetime + self.ldaprefresh < time.time()) ):
-            self.__regularmembers = {}
-            self.__digestmembers = {}
-            self.__updatetime = time.time()
-            if not l:
-                l = self.__ldap_bind()
-            self.__ldap_load_members2(l)
+                dn = _intern(dn)
+                self.__loadaddresses(dn, attrs, snap)
+                if self.ldapfullname and attrs.has_key(self.ldapfullname):
+                    # set full name if defined, kept encoded as it is half
+                    # the size of unicode
+                    snap.names[dn] = attrs[self.ldapfullname][0]
+                if self.ldapmodgroupdn:
+                    self.__loadmoderator(dn, attrs, snap)
+
+    def __loadaddresses(self, dn, attrs, snap):
+        """Set the address of member dn and index all of its addresses"""
+        mail = _intern(attrs['mail'][0].strip())
+        if dn in self.__mlist.digest_members or not self.__mlist.nondigestable:
+            snap.digest[dn] = mail
+        else:
+            snap.regular[dn] = mail
+        if DEBUG:
+            syslog('debug','adding members[lce] = %s' % mail)
+        # mail can have multiple values -- the_olo
+        for maddr in attrs['mail']:
+            snap.member_map[_intern(maddr.strip().lower())] = dn
+        # The other addresses give way to the mail of another member
+        for name in self.ldapmailattrs:
+            for maddr in _get_values(attrs, name):
+                maddr = _normalize_address(maddr)
+                if maddr:
+                    snap.member_map.setdefault(_intern(maddr), dn)
+
+    def __loadmoderator(self, dn, attrs, snap):
+        if self.ldapmodattr:
+            # The entry lists its groups, e.g. in memberOf
+            groupdn = _normalize_dn(self.ldapmodgroupdn)
+            for value in _get_values(attrs, self.ldapmodattr):
+                if _normalize_dn(value) == groupdn:
+                    snap.moderators[dn] = True
+            return
+        for value in _get_values(attrs, self.ldapmemberuid):
+            snap.uids[_intern(value.lower())] = dn
+        gids = []
+        for value in _get_values(attrs, 'destinationindicator'):
+            gids.extend(value.split(','))
+        if gids:
+            snap.indicators[dn] = tuple(gids)
+
+    def __member_attrs(self):
+        """The attributes to fetch for each member"""
+        attr = ['mail'] + list(self.ldapmailattrs)
+        if self.ldapfullname:
+            attr.append(self.ldapfullname)
+        if self.ldapmodgroupdn:
+            if self.ldapmodattr:
+                attr.append(self.ldapmodattr)
+            else:
+                for name in (self.ldapmemberuid, 'destinationindicator'):
+                    if name not in attr:
+                        attr.append(name)
+        return attr
+
+    def __ldap_load_moderators(self, l, snap):
+        """Mark the members in ldapmodgroupdn as moderators.
+
+        The group entry is read with a single search and its member ids are
+        matched against those kept for each member while loading, instead
+        of resolving every moderator with a search of its own.  With
+        ldapmodattr the members were marked while loading already.
+        """
+        if self.ldapmodattr:
+            return
+        groupattr = self.ldapgroupattr or 'memberUid'
+        modids = set()
+        gid = None
+        groups = l.search_s(self.ldapmodgroupdn, ldap.SCOPE_BASE,
+                            '(objectClass=*)', [groupattr, 'gidNumber'])
+        self.__count_search(groups)
+        for (dn, attrs) in groups:
+            modids.update([value.lower() for value
+                           in self.__ldap_values(l, dn, attrs, groupattr)])
+            if attrs.get('gidNumber'):
+                gid = attrs['gidNumber'][0]
+        moderators = {}
+        dns = None
+        for memberid in modids:
+            dn = snap.uids.get(memberid)
+            if dn is None and '=' in memberid:
+                # The group lists DNs
+                if dns is None:
+                    dns = dict([(_normalize_dn(dn), dn) for dn
+                                in snap.regular.keys() + snap.digest.keys()])
+                dn = dns.get(_normalize_dn(memberid))
+            # Skip members excluded from the group by destinationindicator
+            if dn is not None and gid not in snap.indicators.get(dn, ()):
+                moderators[dn] = True
+        snap.moderators = moderators
+
+    def __ldap_load_members(self, force=False, maxage=None):
+        """Return the current snapshot, refreshing it if it is too old.
+
+        With ldapbackground set an outdated snapshot is returned as is while
+        a worker thread loads its replacement.  Only the very first load
+        (and a forced one) makes the caller wait for LDAP.
+
+        If loading fails the last snapshot is kept, and LDAP is not tried
+        again for ldapbackoff seconds, doubling with every failure up to
+        ldapmaxbackoff.  Until then the last snapshot is served, or the
+        error is raised again if there is none.
+        """
+        snap = self.__snapshot
+        now = time.time()
+        if self.ldapstatsinterval and self.__stats_logged + self.ldapstatsinterval < now:
+            self.__stats_log(now)
+        if not force:
+            if snap is not None and snap.updatetime + self.ldaprefresh >= now:
+                self.__stats['snapshot_hits'] += 1
+                return snap
+            if snap is not None and self.ldapbackground:
+                self.__stats['snapshot_hits'] += 1
+                self.__ldap_refresh_background()
+                return snap
+            if not (self.__failures.allow() and self.__breaker().allow()):
+                stale = self.__ldap_stale(snap)
+                if stale is not None:
+                    self.__snapshot = stale
+                    return stale
+                error = self.__failures.error or self.__breaker().error
+                if error is not None:
+                    raise error
+        self.__refresh_lock.acquire()
+        try:
+            # Somebody else may have refreshed while we were waiting
+            if force or self.__snapshot is snap:
+                try:
+                    self.__snapshot = self.__ldap_refresh(self.__snapshot, maxage=maxage)
+                except Exception:
+                    stale = self.__ldap_stale(self.__snapshot)
+                    if force or stale is None:
+                        raise
+                    self.__snapshot = stale
+            return self.__snapshot
+        finally:
+            self.__refresh_lock.release()
+
+    def __breaker(self):
+        """The circuit breaker of the servers, shared with the other lists"""
+        servers = self.__ldap_servers()
+        breaker = _breakers.get(servers)
+        if breaker is None:
+            breaker = _breakers.setdefault(servers, _CircuitBreaker())
+        return breaker
+
+    def __ldap_stale(self, snap):
+        """Return what to serve while LDAP fails: snap or a newer snapshot
+        written by another process, None if there is neither"""
+        if self.ldapsnapshot:
+            snap = self.__snapshot_read(snap)
+        if snap is not None:
+            self.__stats['stale_served'] += 1
+        return snap
+
+    def __ldap_refresh(self, old, pooled=False, maxage=None):
+        """Return a new snapshot, old is not modified.
+
+        With ldapsnapshot set the snapshot is shared with the other Mailman
+        processes through a file in the list directory.  The process that
+        holds the snapshot lock loads from LDAP and writes the file, the
+        others wait for it and read the result.  A file is used if it is
+        younger than maxage, by default ldaprefresh, seconds.
+        """
+        if not self.ldapsnapshot:
+            return self.__ldap_refresh2(old, pooled)
+        if maxage is None:
+            maxage = self.ldaprefresh
+        snap = self.__snapshot_read(old)
+        if snap is not old and snap.updatetime + maxage >= time.time():
+            return snap
+        lock = LockFile.LockFile(self.__snapshot_path() + '.lock',
+                                 lifetime=SNAPSHOT_LOCK_LIFETIME)
+        try:
+            lock.lock(timeout=SNAPSHOT_LOCK_LIFETIME)
+        except LockFile.TimeOutError:
+            syslog('error', 'Timed out waiting for the LDAP snapshot lock of %s'
+                   % self.__mlist.internal_name())
+            return self.__ldap_refresh2(snap, pooled)
+        try:
+            # Another process may have refreshed while we were waiting
+            snap = self.__snapshot_read(snap)
+            if snap is not old and snap.updatetime + maxage >= time.time():
+                return snap
+            snap = self.__ldap_refresh2(snap, pooled)
+            self.__snapshot_write(snap)
+            return snap
+        finally:
+            lock.unlock()
 
+    def __ldap_refresh2(self, old, pooled=False):
+        start = time.time()
+        try:
+            if pooled:
+                snap = self.__ldap_call_pooled(self.__ldap_load, old)
+            else:
+                snap = self.__ldap_call(self.__ldap_load, old)
+        except Exception, e:
+            self.__stats['refresh_failures'] += 1
+            if isinstance(e, (ldap.SERVER_DOWN, ldap.TIMEOUT)):
+                breaker = self.__breaker()
+            else:
+                breaker = self.__failures
+            delay = breaker.failure(e, self.ldapbackoff, self.ldapmaxbackoff)
+            syslog('error', 'LDAP refresh of %s failed, not trying again for %g seconds: %s'
+                   % (self.__mlist.internal_name(), delay, e))
+            raise
+        self.__failures.success()
+        self.__breaker().success()
+        duration = time.time() - start
+        self.__stats['refreshes'] += 1
+        self.__stats['refresh_seconds'] += duration
+        self.__stats['last_refresh_seconds'] = duration
+        self.__stats['member_bytes'] = snap.size()
+        return snap
+
+    def __ldap_load(self, l, old):
+        """Load a new snapshot over connection l"""
+        if ( (old is not None)
+            and (old.watermark is not None)
+            and (old.fullupdatetime + self.ldapfullrefresh >= time.time()) ):
+            snap = old.copy()
+            self.__ldap_load_changes(l, snap)
             if self.ldapmodgroupdn:
-                self.__ldap_load_members2(l, True)
+                self.__ldap_load_moderators(l, snap)
+            return snap
 
-            if self.alwaysDeliver:
-                # FIXME for some reason this not working ...
-                # Manually disable it from the admin interface
-                self.__mlist.bounce_processing = False
+        snap = _Snapshot()
+        self.__ldap_load_members2(l, snap)
+        if snap.watermark is not None:
+            # The watermark only covers the members yet.  Advance it over
+            # the newer entries of the base, applying changes made during
+            # the load, so the next refresh finds nothing to do
+            self.__ldap_load_changes(l, snap)
 
-    def __ldap_load_members2(self, l, moderator=False):
-        attr = ['mail']
-        if not moderator and self.ldapfullname:
-            attr.append(self.ldapfullname)
-        if self.ldapgroupattr or moderator:
-            # group attribute or moderator flag has been set. Let's get the uids.
-            if moderator:
-                assert self.ldapmodgroupdn
-                groupdn = self.ldapmodgroupdn
+        if self.ldapmodgroupdn:
+            self.__ldap_load_moderators(l, snap)
+
+        if self.alwaysDeliver:
+            # FIXME for some reason this not working ...
+            # Manually disable it from the admin interface
+            self.__mlist.bounce_processing = False
+        return snap
+
+    def __snapshot_path(self):
+        return os.path.join(self.__mlist.fullpath(), 'ldap-snapshot.db')
+
+    def __snapshot_config(self):
+        # Settings the snapshot depends on; a file written with other
+        # settings is ignored
+        return repr((self.ldapserver, self.ldapbasedn, self.ldapsearch,
+                     self.ldapgroupdn, self.ldapgroupattr, self.ldapmemberuid,
+                     self.ldapnested, self.ldapmodgroupdn, self.ldapmodattr,
+                     self.ldapfullname, tuple(self.ldapmailattrs)))
+
+    def __snapshot_read(self, current):
+        """Return the on-disk snapshot if it is newer than current"""
+        path = self.__snapshot_path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return current
+        if mtime == self.__snapshot_mtime:
+            return current
+        snap = _Snapshot()
+        try:
+            fp = open(path, 'rb')
+            try:
+                ok = snap.load(fp, self.__snapshot_config())
+            finally:
+                fp.close()
+        except (IOError, EOFError, ValueError, TypeError, KeyError), e:
+            syslog('error', 'Ignoring unreadable LDAP snapshot %s: %s' % (path, e))
+            return current
+        self.__snapshot_mtime = mtime
+        if not ok or (current is not None and current.updatetime >= snap.updatetime):
+            return current
+        self.__stats['snapshot_file_loads'] += 1
+        return snap
+
+    def __snapshot_write(self, snap):
+        path = self.__snapshot_path()
+        tmpfile = '%s.tmp.%d' % (path, os.getpid())
+        try:
+            fp = open(tmpfile, 'wb')
+            try:
+                snap.dump(fp, self.__snapshot_config())
+            finally:
+                fp.close()
+            # Atomic on POSIX, readers see either the old or the new file
+            os.rename(tmpfile, path)
+            self.__snapshot_mtime = os.stat(path).st_mtime
+        except (IOError, OSError), e:
+            syslog('error', 'Could not write LDAP snapshot %s: %s' % (path, e))
+
+    def __ldap_refresh_background(self):
+        """Start a refresh in a worker thread unless one is running"""
+        if not self.__refresh_lock.acquire(False):
+            return
+        if not (self.__failures.allow() and self.__breaker().allow()):
+            self.__refresh_lock.release()
+            return
+        try:
+            worker = threading.Thread(target=self.__ldap_refresh_worker,
+                                      args=(self.__snapshot,))
+            worker.setDaemon(True)
+            worker.start()
+        except:
+            self.__refresh_lock.release()
+            raise
+
+    def __ldap_refresh_worker(self, old):
+        # Runs with __refresh_lock held.  It uses a pooled connection, the
+        # cached one belongs to the request path.
+        try:
+            try:
+                self.__snapshot = self.__ldap_refresh(old, pooled=True)
+            except Exception:
+                # Logged, the old snapshot is served until the next try
+                pass
+        finally:
+            self.__refresh_lock.release()
+
+    def __ldap_load_members2(self, l, snap):
+        attr = self.__member_attrs()
+        if self.ldapgroupattr:
+            # group attribute has been set. Let's get the uids.
+            groupdn = self.ldapgroupdn
+            # The chain search finds the members itself, the group's member
+            # values (and their ranges in AD) are not needed for it
+            if self.ldapnested == 'chain':
+                groupattrs = ['gidNumber']
             else:
-                groupdn = self.ldapgroupdn
-            members = l.search_s(groupdn, ldap.SCOPE_SUBTREE,
-                self.ldapsearch, [self.ldapgroupattr])
-            groups = l.search_s(groupdn, ldap.SCOPE_SUBTREE, "cn=*", ['gidNumber'])
-            (dn, attrs) = groups[0]
-            gid = attrs['gidNumber'][0].decode('utf-8')
+                groupattrs = [self.ldapgroupattr, 'gidNumber']
+            members = []
+            for page in self.__ldap_search_pages(l, groupdn, ldap.SCOPE_SUBTREE,
+                                                 self.ldapsearch, groupattrs):
+                members.extend(page)
+            gid = self.__group_gid(l, groupdn, members)
+            if 'destinationindicator' not in attr:
+                attr.append('destinationindicator')
+            if self.ldapnested == 'chain':
+                self.__ldap_load_chain(l, snap, [dn for (dn, attrs) in members],
+                                       gid, attr)
+                return
+            memberids = []
             for (dn,attrs) in members:
-                if self.ldapgroupattr in attrs:
-                    memberids = attrs[self.ldapgroupattr]
+                values = self.__ldap_values(l, dn, attrs, self.ldapgroupattr)
+                if values:
                     if DEBUG:
-                        syslog('debug','regular groupdns = %s' % groupdns)
-                    for memberid in memberids:
-                        try:
-                            gidsearch = '|(destinationindicator=' + gid + ')(destinationindicator=' + gid + ',*)(destinationindicator=*,' + gid + ')(destinationindicator=*,' + gid + ',*)'
-                            filter = '(&(objectClass=*)(' + self.ldapmemberuid + '=' + memberid.decode('utf8') + ')(!(' + gidsearch + ')))'
-
-                            res2 = l.search_s(self.ldapbasedn,
-                                              ldap.SCOPE_SUBTREE,
-                                              filter,
-                                              attr)
-                            self.__loadmembers(res2, moderator)
-                        except ldap.NO_SUCH_OBJECT:
-                            syslog('warn',"can't process %s: no such object (accountDisabled?)" % memberid)
-
+                        syslog('debug','regular groupdns = %s' % values)
+                    memberids.extend(values)
+            if self.ldapnested == 'walk':
+                self.__ldap_load_dns(l, snap, memberids, gid, attr,
+                                     [dn for (dn, attrs) in members])
+                return
+            if self.ldapsharedcache:
+                self.__shared_load_group(l, snap, memberids, gid, attr)
+                return
+            if self.ldapmemberuid.lower() in ('distinguishedname', 'entrydn'):
+                self.__ldap_load_dns(l, snap, memberids, gid, attr)
+                return
+            if self.ldapbatchsize:
+                self.__ldap_load_batched(l, snap, memberids, gid, attr)
+                return
+            for memberid in memberids:
+                try:
+                    filter = '(' + self.ldapmemberuid + '=' + memberid.decode('utf8') + ')'
+
+                    res2 = l.search_s(self.ldapbasedn,
+                                      ldap.SCOPE_SUBTREE,
+                                      filter,
+                                      attr)
+                    self.__count_search(res2)
+                    self.__loadmembers([(dn, attrs) for (dn, attrs) in res2
+                                        if not _excluded(attrs, gid)], snap)
+                except ldap.NO_SUCH_OBJECT:
+                    syslog('warn',"can't process %s: no such object (accountDisabled?)" % memberid)
+
+        elif self.ldapsharedcache and self.__shared_load_search(l, snap, attr):
+            pass
         else:
-            members = l.search_s(self.ldapbasedn,
-                                ldap.SCOPE_SUBTREE,
-                                self.ldapsearch,
-                                attr)
-            self.__loadmembers(members)
-
-        
-    def __ldap_member_to_key(self, member):
-        key = self.__member_map.get(member.lower(), None)
-        if key:
-            return key
+            if self.ldapincremental:
+                attr.append(self.ldapwatermarkattr)
+            for members in self.__ldap_search_pages(l, self.ldapbasedn,
+                                                    ldap.SCOPE_SUBTREE,
+                                                    self.ldapsearch,
+                                                    attr):
+                self.__loadmembers(members, snap)
+                if self.ldapincremental:
+                    self.__advance_watermark(members, snap)
+
+    def __group_gid(self, l, groupdn, entries):
+        """Return the gidNumber of groupdn.
+
+        Members with it in destinationindicator are excluded from the list.
+        It is taken from the group entry if it is among entries, else read
+        with a base search and cached for ldapgroupttl seconds.
+        """
+        key = (self.__ldap_servers(), _normalize_dn(groupdn))
+        now = time.time()
+        for (dn, attrs) in entries:
+            if attrs.get('gidNumber') and _normalize_dn(dn) == key[1]:
+                gid = attrs['gidNumber'][0]
+                _group_gids[key] = (gid, now)
+                return gid
+        cached = _group_gids.get(key)
+        if cached is not None and cached[1] + self.ldapgroupttl >= now:
+            return cached[0]
+        gid = None
+        groups = l.search_s(groupdn, ldap.SCOPE_BASE, '(objectClass=*)', ['gidNumber'])
+        self.__count_search(groups)
+        for (dn, attrs) in groups:
+            if attrs.get('gidNumber'):
+                gid = attrs['gidNumber'][0]
+        _group_gids[key] = (gid, now)
+        return gid
+
+    def __shared_directory(self, l, attrs):
+        """Return the shared cache of ldapbasedn holding at least attrs"""
+        key = (self.__ldap_servers(), self.ldapbasedn, self.ldapsharedfilter)
+        _directory_lock.acquire()
+        try:
+            lock = _directory_locks.setdefault(key, threading.Lock())
+        finally:
+            _directory_lock.release()
+        lock.acquire()
+        try:
+            cache = _directory_caches.get(key)
+            wanted = set(attrs)
+            if cache is not None:
+                if cache.fresh(wanted, self.ldapsharedttl):
+                    return cache
+                # Keep the attributes other lists asked for
+                wanted = wanted | cache.attrs
+            entries = []
+            for page in self.__ldap_search_pages(l, self.ldapbasedn,
+                                                 ldap.SCOPE_SUBTREE,
+                                                 self.ldapsharedfilter,
+                                                 list(wanted)):
+                entries.extend(page)
+            cache = _directory_caches[key] = _DirectoryCache(wanted, entries)
+            return cache
+        finally:
+            lock.release()
+
+    def __shared_load_group(self, l, snap, memberids, gid, attr):
+        """Resolve group member ids against the shared directory cache.
+
+        Members excluded by destinationindicator are skipped like in the
+        other group loaders.
+        """
+        cache = self.__shared_directory(l, attr + [self.ldapmemberuid,
+                                                   'destinationindicator'])
+        index = cache.index(self.ldapmemberuid)
+        for memberid in memberids:
+            for (dn, entry, lattrs) in index.get(memberid.lower(), ()):
+                if not _excluded(lattrs, gid):
+                    self.__loadmembers([(dn, entry)], snap)
+
+    def __shared_load_search(self, l, snap, attr):
+        """Select the members from the shared directory cache with ldapsearch.
+
+        Returns False if ldapsearch can not be evaluated locally, the
+        caller then searches the directory itself.
+        """
+        try:
+            node = _parse_filter(self.ldapsearch)[0]
+        except ValueError, e:
+            syslog('error', 'Not using the shared LDAP cache for %s: %s'
+                   % (self.__mlist.internal_name(), e))
+            return False
+        cache = self.__shared_directory(l, attr + list(_filter_attrs(node)))
+        self.__loadmembers(cache.search(node), snap)
+        return True
+
+    def __ldap_search_pages(self, l, base, scope, filter, attr):
+        """Search and yield the result one page at a time.
+
+        With ldappagesize set the RFC 2696 Simple Paged Results control is
+        used, so neither we nor the server's sizelimit see the full result
+        set at once.  Otherwise the whole result is yielded as one page.
+        """
+        if not self.ldappagesize:
+            result = l.search_s(base, scope, filter, attr)
+            self.__count_search(result)
+            yield result
+            return
+        ctrl = ldap.controls.SimplePagedResultsControl(True,
+                                                       size=self.ldappagesize,
+                                                       cookie='')
+        while True:
+            msgid = l.search_ext(base, scope, filter, attr, serverctrls=[ctrl])
+            (rtype, rdata, rmsgid, rctrls) = l.result3(msgid)
+            self.__count_search(rdata)
+            yield rdata
+            cookie = None
+            for c in rctrls:
+                if c.controlType == ldap.controls.SimplePagedResultsControl.controlType:
+                    cookie = c.cookie
+            if not cookie:
+                break
+            ctrl.cookie = cookie
+
+    def __watermark_key(self, value):
+        # uSNChanged is numeric, timestamps compare as strings
+        if value.isdigit():
+            return int(value)
+        return value
+
+    def __advance_watermark(self, result, snap):
+        for (dn, attrs) in result:
+            values = attrs.get(self.ldapwatermarkattr)
+            if not values:
+                continue
+            mark = values[0]
+            if (snap.watermark is None
+                or self.__watermark_key(mark) > self.__watermark_key(snap.watermark)):
+                snap.watermark = mark
+                snap.watermark_dns = set([dn])
+            elif mark == snap.watermark:
+                snap.watermark_dns.add(dn)
+
+    def __ldap_load_changes(self, l, snap):
+        """Apply the entries changed since the last refresh.
+
+        The first search only asks for the watermark attribute of entries
+        changed since the last refresh, so a refresh without changes is a
+        single search that returns the entries already seen.  Entries that
+        changed but no longer match ldapsearch are removed.
+
+        Deleted and renamed entries are not found by the watermark, so when
+        anything changed a second search fetches only the DNs matching
+        ldapsearch, and members that are not among them are dropped.  A
+        deletion without any other change waits for the next change or the
+        full reload after ldapfullrefresh seconds.
+        """
+        since = '(%s>=%s)' % (self.ldapwatermarkattr,
+                              ldap.filter.escape_filter_chars(snap.watermark))
+        changed = []
+        for page in self.__ldap_search_pages(l, self.ldapbasedn,
+                                             ldap.SCOPE_SUBTREE, since,
+                                             [self.ldapwatermarkattr]):
+            for (dn, attrs) in page:
+                values = attrs.get(self.ldapwatermarkattr)
+                if (values and values[0] == snap.watermark
+                    and dn in snap.watermark_dns):
+                    continue
+                changed.append((dn, attrs))
+        if not changed:
+            return
+        self.__advance_watermark(changed, snap)
+        changed = set([dn for (dn, attrs) in changed])
+
+        search = self.ldapsearch
+        if not search.startswith('('):
+            search = '(' + search + ')'
+        present = set()
+        for page in self.__ldap_search_pages(l, self.ldapbasedn,
+                                             ldap.SCOPE_SUBTREE, search,
+                                             ['1.1']):
+            for (dn, attrs) in page:
+                present.add(_normalize_dn(dn))
+        for members in (snap.regular, snap.digest):
+            for dn in members:
+                if _normalize_dn(dn) not in present:
+                    changed.add(dn)
+        snap.remove(changed)
+
+        attr = self.__member_attrs()
+        for members in self.__ldap_search_pages(l, self.ldapbasedn,
+                                                ldap.SCOPE_SUBTREE,
+                                                '(&' + search + since + ')',
+                                                attr):
+            self.__loadmembers([(dn, attrs) for (dn, attrs) in members
+                                if dn in changed], snap)
+        snap.changed()
+
+    def __ldap_load_batched(self, l, snap, memberids, gid, attr):
+        """Resolve group member ids with one OR filter per ldapbatchsize ids.
+
+        The searches are issued asynchronously, with up to BATCH_WINDOW of
+        them outstanding, instead of one blocking search per member id.
+        """
+        size = self.ldapbatchsize
+        chunks = [memberids[i:i + size] for i in range(0, len(memberids), size)]
+        pending = []
+        try:
+            while chunks or pending:
+                while chunks and len(pending) < BATCH_WINDOW:
+                    chunk = chunks.pop(0)
+                    uids = ''.join(['(%s=%s)' % (self.ldapmemberuid,
+                                                 ldap.filter.escape_filter_chars(memberid))
+                                    for memberid in chunk])
+                    filter = '(|' + uids + ')'
+                    msgid = l.search_ext(self.ldapbasedn, ldap.SCOPE_SUBTREE,
+                                         filter, attr)
+                    pending.append((chunk, msgid))
+                (chunk, msgid) = pending.pop(0)
+                try:
+                    (rtype, rdata, rmsgid, rctrls) = l.result3(msgid)
+                    self.__count_search(rdata)
+                    self.__loadmembers([(dn, attrs) for (dn, attrs) in rdata
+                                        if not _excluded(attrs, gid)], snap)
+                except ldap.NO_SUCH_OBJECT:
+                    syslog('warn',"can't process %s: no such object (accountDisabled?)" % ', '.join(chunk))
+        finally:
+            # Left over when a search failed
+            _abandon(l, [msgid for (chunk, msgid) in pending])
+
+    def __ldap_values(self, l, dn, attrs, name):
+        """Return all values of attribute name of entry dn.
+
+        Active Directory returns at most MaxValRange (1500) values of an
+        attribute, as name;range=0-1499.  The others are fetched with base
+        searches for the following ranges.
+        """
+        values = _get_values(attrs, name)
+        if values:
+            return values
+        prefix = name.lower() + ';range='
+        for (key, chunk) in attrs.items():
+            if key.lower().startswith(prefix):
+                break
+        else:
+            return ()
+        values = list(chunk)
+        while not key.endswith('-*'):
+            end = int(key[len(prefix):].split('-')[1])
+            result = l.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                                ['%s;range=%d-*' % (name, end + 1)])
+            self.__count_search(result)
+            found = False
+            for (rdn, rattrs) in result:
+                for (rkey, chunk) in rattrs.items():
+                    if rkey.lower().startswith(prefix):
+                        values.extend(chunk)
+                        key = rkey
+                        found = True
+            if not found:
+                break
+        return values
+
+    def __ldap_read_dns(self, l, dns, attr):
+        """Read the entries dns with base searches, yield the results.
+
+        The searches are issued asynchronously with up to READ_WINDOW of
+        them outstanding.  Entries that do not exist are skipped.
+        """
+        pending = []
+        i = 0
+        try:
+            while i < len(dns) or pending:
+                while i < len(dns) and len(pending) < READ_WINDOW:
+                    msgid = l.search_ext(dns[i], ldap.SCOPE_BASE, '(objectClass=*)', attr)
+                    pending.append((dns[i], msgid))
+                    i += 1
+                (dn, msgid) = pending.pop(0)
+                try:
+                    (rtype, rdata, rmsgid, rctrls) = l.result3(msgid)
+                except ldap.NO_SUCH_OBJECT:
+                    syslog('warn',"can't process %s: no such object (accountDisabled?)" % dn)
+                    continue
+                self.__count_search(rdata)
+                yield rdata
+        finally:
+            # Left over when a read failed or the caller stopped early
+            _abandon(l, [msgid for (dn, msgid) in pending])
+
+    def __ldap_load_dns(self, l, snap, dns, gid, attr, groupdns=None):
+        """Load the members from their DNs (e.g. the member values of an AD
+        group) with base reads instead of searches of the whole base DN.
+
+        With groupdns, the DNs of the groups being loaded, member entries
+        that are groups themselves are expanded one level at a time.  Every
+        DN is read once, so membership cycles end.
+        """
+        nested = groupdns is not None
+        if nested:
+            attr = attr + ['objectClass', self.ldapgroupattr]
+            seen = set([_normalize_dn(dn) for dn in groupdns])
+        else:
+            seen = set()
+        while dns:
+            todo = []
+            for dn in dns:
+                key = _normalize_dn(dn)
+                if key not in seen:
+                    seen.add(key)
+                    todo.append(dn)
+            dns = []
+            for result in self.__ldap_read_dns(l, todo, attr):
+                for (dn, attrs) in result:
+                    if nested:
+                        classes = [value.lower() for value in _get_values(attrs, 'objectClass')]
+                        members = self.__ldap_values(l, dn, attrs, self.ldapgroupattr)
+                        if members or 'group' in classes or 'groupofnames' in classes:
+                            dns.extend(members)
+                            continue
+                    if not _excluded(attrs, gid):
+                        self.__loadmembers([(dn, attrs)], snap)
+
+    def __ldap_load_chain(self, l, snap, groupdns, gid, attr):
+        """Load the members of groupdns and of the groups nested in them.
+
+        Active Directory resolves the nesting itself for a memberOf filter
+        with LDAP_MATCHING_RULE_IN_CHAIN, so this is one search per group.
+        """
+        for groupdn in groupdns:
+            filter = ('(&(memberOf:%s:=%s)(!(objectClass=group)))'
+                      % (IN_CHAIN, ldap.filter.escape_filter_chars(groupdn)))
+            for page in self.__ldap_search_pages(l, self.ldapbasedn,
+                                                 ldap.SCOPE_SUBTREE, filter, attr):
+                self.__loadmembers([(dn, attrs) for (dn, attrs) in page
+                                    if not _excluded(attrs, gid)], snap)
+
+    def __ldap_member_to_key(self, member, snap=None):
+        if snap is None:
+            snap = self.__snapshot
+        if snap is not None:
+            key = snap.member_map.get(member.lower(), None)
+            if key:
+                self.__stats['lookup_hits'] += 1
+                return key
+            if member not in snap.regular and member not in snap.digest:
+                self.__stats['lookup_misses'] += 1
         # Might alreay be a key ...
         return member
 
+    def __count_search(self, result):
+        self.__stats['searches'] += 1
+        self.__stats['entries'] += len(result)
+
+    #
+    # Maintenance
+    #
+    def refresh(self, maxage=None):
+        """Load the members and update the old style storage.
+
+        Used by bin/ldap_prewarm to load the members before the list
+        sees traffic.  The in-memory snapshot is always replaced; with
+        ldapsnapshot set the file is reused if it is younger than maxage
+        (default ldaprefresh) seconds, else reloaded from LDAP and
+        rewritten.  The list is locked and saved at most once.  Returns
+        the number of members.
+        """
+        snap = self.__ldap_load_members(force=True, maxage=maxage)
+        self.__syncOldStyleStorage()
+        return len(snap.regular) + len(snap.digest)
+
+    #
+    # Roster, for the admin membership pages
+    #
+    def getRosterLetters(self, text=None):
+        """Return the first letters of the member addresses, sorted.
+
+        With text only the members whose address or full name contains
+        text, ignoring case, are looked at.
+        """
+        roster = self.__ldap_load_members().roster()
+        if not text:
+            return sorted(roster.buckets)
+        letters = set()
+        for i in roster.search(text):
+            letters.add(roster.addresses[i][:1])
+        return sorted(letters)
+
+    def getRosterPage(self, letter=None, text=None, start=0, count=None):
+        """Return (rows, total) for a page of the members sorted by address.
+
+        rows holds (address, full name) of at most count members from
+        position start on, total is the number of members to page
+        through.  letter restricts them to the addresses starting with
+        it, text like in getRosterLetters().  The roster is kept with the
+        snapshot, so a page costs its size and the matches of text rather
+        than sorting and scanning the whole list.
+        """
+        roster = self.__ldap_load_members().roster()
+        if letter is None:
+            (first, end) = (0, len(roster.addresses))
+        else:
+            (first, end) = roster.buckets.get(letter.lower(), (0, 0))
+        if text:
+            positions = roster.search(text)
+            positions = positions[bisect_left(positions, first):bisect_left(positions, end)]
+            total = len(positions)
+            if count is not None:
+                positions = positions[start:start + count]
+            else:
+                positions = positions[start:]
+        else:
+            total = end - first
+            if count is not None:
+                end = min(end, first + start + count)
+            positions = xrange(first + start, end)
+        return ([roster.row(i) for i in positions], total)
+
+    #
+    # Instrumentation
+    #
+    def stats(self):
+        """Return a dict of refresh, LDAP and lookup counters.
+
+        Besides the counters kept since the adaptor was created it holds
+        the current number of members and the age of the snapshot.
+        """
+        stats = self.__stats.copy()
+        stats['directory_failures'] = self.__breaker().failures
+        snap = self.__snapshot
+        if snap is not None:
+            stats['members'] = len(snap.regular) + len(snap.digest)
+            stats['snapshot_age'] = time.time() - snap.updatetime
+        else:
+            stats['members'] = 0
+            stats['snapshot_age'] = None
+        return stats
+
+    def __stats_log(self, now):
+        self.__stats_logged = now
+        stats = self.stats()
+        syslog('ldapstats', '%s: ' % self.__mlist.internal_name()
+               + ' '.join(['%s=%s' % (key, stats[key]) for key in sorted(stats)]))
+
+    def __install_timer(self):
+        """Report the duration of every MemberAdaptor call to ldaptimer.
+
+        The methods are wrapped on the instance, so there is no cost
+        without a timer.  Calls made by other methods are reported too.
+        """
+        timer = self.ldaptimer
+        def timed(name, method):
+            def wrapper(*args, **kws):
+                start = time.time()
+                try:
+                    return method(*args, **kws)
+                finally:
+                    timer(name, time.time() - start)
+            return wrapper
+        for name in TIMED_METHODS:
+            setattr(self, name, timed(name, getattr(self, name)))
+
     def __ldap_get_member_cpe(self, member):
-        self.__ldap_load_members()
-        member = self.__ldap_member_to_key(member)
-        cpe = self.__regularmembers.get(member, None)
+        snap = self.__ldap_load_members()
+        member = self.__ldap_member_to_key(member, snap)
+        cpe = snap.regular.get(member, None)
         if cpe:
             return cpe
-        return self.__digestmembers.get(member, None)
+        return snap.digest.get(member, None)
 
     def __ldap_mail_to_cn(self, member):
-        self.__ldap_load_members()
-        member = self.__ldap_member_to_key(member)
-        return self.__member_names.get(member, None)
-
-    def __ldap_update_mail(self, member, newaddress):
+        snap = self.__ldap_load_members()
+        member = self.__ldap_member_to_key(member, snap)
+        return snap.name(member)
+
+    def __ldap_update_mails(self, changes):
+        """Change the mail of entries, changes is a list of (dn, oldaddress,
+        newaddress).
+
+        The modifications are sent asynchronously with up to BATCH_WINDOW
+        of them outstanding.  Returns ({dn: error}, {dn: error}), those
+        that failed and those that may have succeeded.
+
+        If the server of a connection kept from an earlier call goes away,
+        only the modifications without a result are sent again on a new
+        connection.  They may have been applied already, so the old value
+        missing or the new one present is no failure on a resend; the
+        caller reads those entries back to know.
+        """
+        failed = {}
+        unsure = {}
+        resent = set()
+        reused = self.__ldap_conn is not None
         l = self.__ldap_bind()
-        dn = self.__ldap_member_to_key(member)
-        oldaddress = self.getMemberCPAddress(member)
-        modlist = ldap.modlist.modifyModlist({'mail': oldaddress},
-                                             {'mail': newaddress})
-        l.modify_s(dn, modlist)
+        pending = []
+        i = 0
+        while True:
+            try:
+                while i < len(changes) or pending:
+                    while i < len(changes) and len(pending) < BATCH_WINDOW:
+                        (dn, oldaddress, newaddress) = changes[i]
+                        # Only this value, the entry may have more
+                        modlist = [(ldap.MOD_DELETE, 'mail', [oldaddress]),
+                                   (ldap.MOD_ADD, 'mail', [newaddress])]
+                        pending.append((changes[i], l.modify_ext(dn, modlist)))
+                        i += 1
+                    (change, msgid) = pending[0]
+                    dn = change[0]
+                    try:
+                        l.result3(msgid)
+                    except (ldap.NO_SUCH_ATTRIBUTE,
+                            ldap.TYPE_OR_VALUE_EXISTS), e:
+                        if dn in resent:
+                            unsure[dn] = e
+                        else:
+                            failed[dn] = e
+                    except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+                        raise
+                    except ldap.LDAPError, e:
+                        failed[dn] = e
+                    del pending[0]
+                return (failed, unsure)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT), e:
+                self.__ldap_conn = None
+                if not reused:
+                    raise
+                reused = False
+                syslog('warn', 'Lost LDAP connection for %s, sending %d '
+                       'address changes again: %s'
+                       % (self.__mlist.internal_name(), len(pending), e))
+                # The changes not sent yet follow those without a result
+                changes = [change for (change, msgid) in pending] + changes[i:]
+                resent = set([change[0] for (change, msgid) in pending])
+                pending = []
+                i = 0
+                l = self.__ldap_bind()
 
-        # Load new values
-        self.__updatetime = 0
-        self.__ldap_load_members(l)
+    def __ldap_read_addresses(self, l, dns):
+        """Return (dn, attrs) with the addresses of those of the entries
+        dns that still have a mail, dn as given"""
+        keys = dict([(_normalize_dn(dn), dn) for dn in dns])
+        entries = []
+        for result in self.__ldap_read_dns(l, dns, ['mail'] + list(self.ldapmailattrs)):
+            for (dn, attrs) in result:
+                if 'mail' in attrs:
+                    entries.append((keys.get(_normalize_dn(dn), dn), attrs))
+        return entries
 
     def __addOldStyleMember(self, member):
         """Initializes additional data for this member"""
         assert self.__mlist.Locked()
 
-        self.setMemberPassword(member, Utils.MakeRandomPassword())
-        self.setMemberLanguage(member, self.__mlist.preferred_language)
+        # Set directly, setMemberPassword() and setMemberLanguage() would
+        # check the membership of every new member again
+        self.__mlist.passwords[member] = Utils.MakeRandomPassword()
+        self.__mlist.language[member] = self.__mlist.preferred_language
         if self.__mlist.new_member_options:
             self.__mlist.user_options[member] = self.__mlist.new_member_options
 
@@ -218,17 +1754,31 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
             if dict.has_key(member):
                 del dict[member]
 
+    def __oldStyleDiff(self, snap):
+        """Return the members to add to and to delete from the old style storage"""
+        members = self.__mlist.members
+        digests = self.__mlist.digest_members
+        newMembers = [member for member in snap.regular.keys() + snap.digest.keys()
+                      if member not in members and member not in digests]
+        oldMembers = [member for member in members.keys() + digests.keys()
+                      if member not in snap.regular and member not in snap.digest]
+        return (newMembers, oldMembers)
+
     def __syncOldStyleStorage(self):
-        """Synchronize OldStyle data with LDAP"""
+        """Synchronize OldStyle data with LDAP
 
-        # LDAP list (loads current data from LDAP)
-        ldapMembers = set(self.__regularmembers.keys() + self.__digestmembers.keys())
-        # Old style members
-        oldStyleMembers = set(self.__mlist.members.keys() + self.__mlist.digest_members.keys())
-        # Members we need to add to the old style storage
-        newMembers = ldapMembers - oldStyleMembers
-        # Members we need to delete from the old style storage
-        oldMembers = oldStyleMembers - ldapMembers
+        This only does work when the snapshot changed since the last call,
+        and only locks and saves the list when the stored members differ.
+        """
+        snap = self.__snapshot
+        if snap is self.__synced:
+            return
+        if ( (self.__mlist.members is snap.regular
+              or self.__mlist.members == snap.regular)
+            and (self.__mlist.digest_members is snap.digest
+                 or self.__mlist.digest_members == snap.digest) ):
+            self.__synced = snap
+            return
 
         # Now lock the list and update the old style storge
         if self.__mlist.Locked():
@@ -238,16 +1788,23 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
             unlock = True
 
         try:
+            # Locking may have reloaded the list, compute the changes now
+            (newMembers, oldMembers) = self.__oldStyleDiff(snap)
             for member in newMembers:
                 self.__addOldStyleMember(member)
             for member in oldMembers:
                 self.__delOldStyleMember(member)
 
-            # Update regular/digest list
-            self.__mlist.members = self.__regularmembers
-            self.__mlist.digest_members = self.__digestmembers
+            if ( newMembers or oldMembers
+                or self.__mlist.members != snap.regular
+                or self.__mlist.digest_members != snap.digest ):
+                # Update regular/digest list
+                self.__mlist.members = snap.regular
+                self.__mlist.digest_members = snap.digest
 
-            self.__mlist.Save()
+                self.__mlist.Save()
+                self.__stats['saves'] += 1
+            self.__synced = snap
         finally:
            if unlock:
                self.__mlist.Unlock()
@@ -256,40 +1813,75 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
         """Set default values for options"""
         if not hasattr(self, 'ldapmemberuid'):
             self.ldapmemberuid = 'uid'
+        if not hasattr(self, 'ldapmailattrs'):
+            self.ldapmailattrs = ()
+        elif isinstance(self.ldapmailattrs, StringType):
+            self.ldapmailattrs = tuple(self.ldapmailattrs.split())
         if not hasattr(self, 'ldapmodgroupdn'):
             self.ldapmodgroupdn = None
+        if not hasattr(self, 'ldapmodattr'):
+            self.ldapmodattr = None
+        if not hasattr(self, 'ldapgroupttl'):
+            self.ldapgroupttl = 3600
+        if not hasattr(self, 'ldapnested'):
+            self.ldapnested = None
         if not hasattr(self, 'alwaysDeliver'):
             self.alwaysDeliver = False
+        if not hasattr(self, 'ldapbatchsize'):
+            self.ldapbatchsize = 0
+        if not hasattr(self, 'ldappagesize'):
+            self.ldappagesize = 0
+        if not hasattr(self, 'ldapincremental'):
+            self.ldapincremental = False
+        if not hasattr(self, 'ldapwatermarkattr'):
+            self.ldapwatermarkattr = 'modifyTimestamp'
+        if not hasattr(self, 'ldapfullrefresh'):
+            self.ldapfullrefresh = 4 * self.ldaprefresh
+        if not hasattr(self, 'ldapbackground'):
+            self.ldapbackground = False
+        if not hasattr(self, 'ldapsnapshot'):
+            self.ldapsnapshot = False
+        if not hasattr(self, 'ldapsharedcache'):
+            self.ldapsharedcache = False
+        if not hasattr(self, 'ldapsharedfilter'):
+            self.ldapsharedfilter = '(mail=*)'
+        if not hasattr(self, 'ldapsharedttl'):
+            self.ldapsharedttl = 300
+        if not hasattr(self, 'ldapconnecttimeout'):
+            self.ldapconnecttimeout = 10
+        if not hasattr(self, 'ldaptimeout'):
+            self.ldaptimeout = 120
+        if not hasattr(self, 'ldappoolsize'):
+            self.ldappoolsize = 4
+        if not hasattr(self, 'ldapbackoff'):
+            self.ldapbackoff = 5
+        if not hasattr(self, 'ldapmaxbackoff'):
+            self.ldapmaxbackoff = 300
+        if not hasattr(self, 'ldapstatsinterval'):
+            self.ldapstatsinterval = 0
+        if not hasattr(self, 'ldaptimer'):
+            self.ldaptimer = None
+        if self.ldaptimer and 'isMember' not in self.__dict__:
+            self.__install_timer()
 
     #
     # Read interface
     #
             
     def getMembers(self):
-        self.__ldap_load_members()
-        v = self.__regularmembers.values() + self.__digestmembers.values()
-        if not v:
-            return []
-        return map(str.lower, v)
+        # Callers may modify the list, so hand out a copy
+        return list(self.__ldap_load_members().memberlists()[0])
 
     def getRegularMemberKeys(self):
-        self.__ldap_load_members()
-        v = self.__regularmembers.values()
-        if not v:
-            return []
-        return map(str.lower, v)
+        return list(self.__ldap_load_members().memberlists()[1])
 
     def getDigestMemberKeys(self):
-        self.__ldap_load_members()
-        v = self.__digestmembers.values()
-        if not v:
-            return []
-        return map(str.lower, v)
+        return list(self.__ldap_load_members().memberlists()[2])
 
     def isMember(self, member):
-        self.__ldap_load_members()
-        member = self.__ldap_member_to_key(member)
-        return (member in self.__regularmembers) or (member in self.__digestmembers)
+        snap = self.__ldap_load_members()
+        member = self.__ldap_member_to_key(member, snap)
+        return (member in snap.regular) or (member in snap.digest)
                
     def __assertIsMember(self, member):
         if not self.isMember(member):
@@ -306,7 +1898,16 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
         return cpaddr
 
     def getMemberCPAddresses(self, members):
-        return [self.__ldap_get_member_cpe(member) for member in members]
+        # One freshness check for the whole batch
+        snap = self.__ldap_load_members()
+        result = []
+        for member in members:
+            member = self.__ldap_member_to_key(member, snap)
+            cpe = snap.regular.get(member, None)
+            if not cpe:
+                cpe = snap.digest.get(member, None)
+            result.append(cpe)
+        return result
 
     def getMemberPassword(self, member):
         self.__ldap_load_members()
@@ -337,9 +1938,9 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
 
         member = self.__ldap_member_to_key(member)
         if flag == mm_cfg.Digests:
-            return member in self.__digestmembers.keys()
+            return member in self.__snapshot.digest
         if flag == mm_cfg.Moderate and self.ldapmodgroupdn:
-            if member in self.__mod_members:
+            if member in self.__snapshot.moderators:
                  return False
             return self.__mlist.default_member_moderation
         option = self.__mlist.user_options.get(member,
@@ -383,8 +1984,69 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
                                                MemberAdaptor.BYUSER,
                                                MemberAdaptor.BYADMIN,
                                                MemberAdaptor.BYBOUNCE)):
-        return [member for member in self.getMembers()
-                if self.getDeliveryStatus(member) in status]
+        snap = self.__ldap_load_members()
+        if MemberAdaptor.ENABLED not in status:
+            # Only members with a delivery_status entry can match, which
+            # usually are far fewer than the members
+            members = [(member, snap.regular.get(member) or snap.digest.get(member))
+                       for member in self.__mlist.delivery_status.keys()]
+        else:
+            members = snap.regular.items() + snap.digest.items()
+        result = []
+        for (member, addr) in members:
+            if addr is None:
+                continue
+            if self.__deliveryStatus(member) in status:
+                result.append(addr.lower())
+        return result
+
+    def __deliveryStatus(self, member):
+        # getDeliveryStatus() for a member key already known to be a member
+        status = self.__mlist.delivery_status.get(member,
+                                                  (MemberAdaptor.ENABLED, 0))[0]
+        if status != MemberAdaptor.BYADMIN and self.alwaysDeliver:
+            return MemberAdaptor.ENABLED
+        return status
+
+    def getMemberInfos(self, members=None):
+        """Return (address, name, language, digest, options, status) tuples.
+
+        This is the data the admin membership page needs per member, for
+        the given members or all of them, with one freshness check.
+        options is the option bitfield as getMemberOption() sees it, and
+        status is the delivery status.
+        """
+        snap = self.__ldap_load_members()
+        if members is None:
+            keys = snap.regular.keys() + snap.digest.keys()
+        else:
+            keys = []
+            for member in members:
+                key = self.__ldap_member_to_key(member, snap)
+                if key not in snap.regular and key not in snap.digest:
+                    raise Errors.NotAMemberError, member
+                keys.append(key)
+        languages = self.__mlist.GetAvailableLanguages()
+        preferred = self.__mlist.preferred_language
+        result = []
+        for key in keys:
+            addr = snap.regular.get(key)
+            digest = addr is None
+            if digest:
+                addr = snap.digest[key]
+            lang = self.__mlist.language.get(key, preferred)
+            if lang not in languages:
+                lang = preferred
+            options = self.__mlist.user_options.get(key,
+                self.__mlist.new_member_options)
+            if self.ldapmodgroupdn:
+                if key not in snap.moderators and self.__mlist.default_member_moderation:
+                    options = options | mm_cfg.Moderate
+                else:
+                    options = options & ~mm_cfg.Moderate
+            result.append((addr.lower(), snap.name(key), lang, digest,
+                           options, self.__deliveryStatus(key)))
+        return result
 
     def getBouncingMembers(self):
         if self.alwaysDeliver:
@@ -412,41 +2074,84 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
             # Can modify the address but not create a new one
             raise NotImplementedError
 
-        assert self.__mlist.Locked()
-
         # Make sure the old address is a member
         self.__assertIsMember(member)
 
-        # Get old values
-        member = self.__ldap_member_to_key(member)
-        digestsp = self.getMemberOption(member, mm_cfg.Digests)
-        password = self.__mlist.passwords.get(member, None)
-        lang = self.getMemberLanguage(member)
-        flags = self.__mlist.user_options.get(member, 0)
-        delivery = self.__getDelivery(member)
-        topics = self.getMemberTopics(member)
-
-        # Update LDAP
-        self.__ldap_update_mail(member, newaddress)
-
-        # Save old values for new member
-        newmember = newaddress.lower()
-        if digestsp:
-            self.__mlist.digest_members[newmember] = newaddress
-        else:
-            self.__mlist.members[newmember] = newaddress
-        if password:
-            self.__mlist.passwords[newmember] = password
-        self.__mlist.language[newmember] = lang
-        if flags:
-            self.__mlist.user_options[newmember] = flags
-        if delivery[0] in (MemberAdaptor.BYUSER, MemberAdaptor.BYADMIN):
-            self.__mlist.delivery_status[newmember] = delivery
-        if topics:
-            self.__mlist.topics_userinterest[newmember] = topics
+        failed = self.changeMemberAddresses([(member, newaddress)])
+        if failed:
+            raise failed.values()[0]
 
-        # Delete the old user data
+    def changeMemberAddresses(self, changes):
+        """Change the addresses of several members at once.
+
+        changes is a list of (member, newaddress).  The LDAP entries are
+        modified in a pipeline and only their addresses read back instead of
+        reloading the members, and the list is saved once.  The old style
+        data (password, options, ...) is keyed by DN, so it stays with the
+        member.  Returns {member: error} for the changes that failed.
+        """
+        assert self.__mlist.Locked()
+
+        snap = self.__ldap_load_members()
+        failed = {}
+        todo = []
+        members = {}
+        for (member, newaddress) in changes:
+            dn = self.__ldap_member_to_key(member, snap)
+            oldaddress = snap.regular.get(dn) or snap.digest.get(dn)
+            if oldaddress is None:
+                failed[member] = Errors.NotAMemberError(member)
+                continue
+            todo.append((dn, oldaddress, newaddress))
+            members[dn] = member
+
+        (errors, unsure) = self.__ldap_update_mails(todo)
+        changed = []
+        for (dn, oldaddress, newaddress) in todo:
+            if dn in errors:
+                failed[members[dn]] = errors[dn]
+            else:
+                changed.append(dn)
+        if not changed:
+            return failed
+        # Read back what the next refresh will see: the server orders the
+        # mail values, and ldapmailattrs may still list the old address
+        entries = self.__ldap_call(self.__ldap_read_addresses, changed)
+
+        # A change sent again after a lost connection succeeded if the
+        # entry has the new mail and no longer the old one
+        mails = {}
+        for (dn, attrs) in entries:
+            mails[dn] = [value.lower() for value in attrs.get('mail', ())]
+        for (dn, oldaddress, newaddress) in todo:
+            if dn in unsure:
+                values = mails.get(dn, ())
+                if (newaddress.lower() not in values
+                        or oldaddress.lower() in values):
+                    failed[members[dn]] = unsure[dn]
+
+        # Under the lock, so a background refresh that started before the
+        # modifications can not install its members after ours
+        self.__refresh_lock.acquire()
+        try:
+            old = self.__snapshot
+            snap = old.copy()
+            snap.updatetime = old.updatetime
+            changed = set(changed)
+            snap.forget_addresses(changed)
+            for (dn, attrs) in entries:
+                self.__loadaddresses(dn, attrs, snap)
+                changed.discard(dn)
+            if changed:
+                # Gone since the modification
+                snap.remove(changed)
+            self.__snapshot = snap
+        finally:
+            self.__refresh_lock.release()
+        if self.ldapsnapshot:
+            self.__snapshot_write(snap)
         self.__syncOldStyleStorage()
+        return failed
 
     def setMemberPassword(self, memberkey, password):
         assert self.__mlist.Locked()
@@ -464,6 +2169,7 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
         assert self.__mlist.Locked()
         self.__assertIsMember(member)
         member = self.__ldap_member_to_key(member)
+        snap = self.__snapshot
         # There's one extra gotcha we have to deal with.  If the user is
         # toggling the Digests flag, then we need to move their entry from
         # mlist.members to mlist.digest_members or vice versa.  Blarg.  Do
@@ -474,13 +2180,13 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
                 if not self.__mlist.digestable:
                     raise Errors.CantDigestError
                 # The user is turning on digest mode
-                if self.__digestmembers.has_key(member):
+                if snap.digest.has_key(member):
                     raise Errors.AlreadyReceivingDigests, member
-                cpuser = self.__regularmembers.get(member)
+                cpuser = snap.regular.get(member)
                 if cpuser is None:
                     raise Errors.NotAMemberError, member
-                del self.__regularmembers[member]
-                self.__digestmembers[member] = cpuser
+                del snap.regular[member]
+                snap.digest[member] = cpuser
                 # If we recently turned off digest mode and are now
                 # turning it back on, the member may be in one_last_digest.
                 # If so, remove it so the member doesn't get a dup of the
@@ -492,19 +2198,20 @@ class LDAP2Memberships(MemberAdaptor.MemberAdaptor):
                 if not self.__mlist.nondigestable:
                     raise Errors.MustDigestError
                 # The user is turning off digest mode
-                if self.__regularmembers.has_key(member):
+                if snap.regular.has_key(member):
                     raise Errors.AlreadyReceivingRegularDeliveries, member
-                cpuser = self.__digestmembers.get(member)
+                cpuser = snap.digest.get(member)
                 if cpuser is None:
                     raise Errors.NotAMemberError, member
-                del self.__digestmembers[member]
-                self.__regularmembers[member] = cpuser
+                del snap.digest[member]
+                snap.regular[member] = cpuser
                 # When toggling off digest delivery, we want to be sure to set
                 # things up so that the user receives one last digest,
                 # otherwise they may lose some email
                 self.__mlist.one_last_digest[member] = cpuser
-            self.__mlist.members = self.__regularmembers
-            self.__mlist.digest_members = self.__digestmembers
+            self.__mlist.members = snap.regular
+            self.__mlist.digest_members = snap.digest
+            snap.changed()
             # We don't need to touch user_options because the digest state
             # isn't kept as a bitfield flag.
             return
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+"""Refresh and lookup benchmark for LDAP2Memberships.
+
+Runs against the in-memory directory of harness.py, so no LDAP server or
+Mailman installation is needed, only a Python 2 interpreter.
+
+Usage: python bench_adaptor.py [options] [size ...]
+
+    -m MODE         search, group, moderated or nested (default: search)
+    -o NAME=VALUE   set an adaptor option, e.g. -o ldapbatchsize=100;
+                    may be given several times
+    -t SECONDS      minimum time spent measuring each call (default: 0.2)
+    -l SECONDS      simulated network latency per LDAP operation
+
+Each size (default: 1000 10000) is run in its own process, so the memory
+figures of one run do not include the previous ones.
+"""
+
+import getopt
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+def admin_page(mlist, regexp, chunksize=30):
+    """What Mailman's admin members page does with findmember set"""
+    members = mlist.getMembers()
+    members.sort(lambda x, y: cmp(x.lower(), y.lower()))
+    cre = re.compile(regexp, re.IGNORECASE)
+    names = [mlist.getMemberName(member) or '' for member in members]
+    members = [member for (name, member) in zip(names, members)
+               if cre.search(name) or cre.search(member)]
+    return members[:chunksize]
+
+
+def run(size, mode, options, mintime, latency):
+    import harness
+    from harness import server, address, alternate_address
+
+    harness.populate(size)
+    server.latency = latency
+    before = harness.rss()
+    mlist = harness.make_list('bench', mode, **options)
+
+    start = time.time()
+    members = mlist.getMembers()
+    refresh = time.time() - start
+    roundtrips = server.roundtrips()
+    entries = server.stats['entries']
+    memory = harness.peak_rss() - before
+    snapshot = mlist._memberadaptor._LDAP2Memberships__snapshot
+    snapshot.memberlists()
+    snapshot_size = harness.deep_size(snapshot)
+
+    # user0 is excluded from the staff group by its destinationindicator
+    hit = address(2)
+    miss = 'nobody@example.org'
+    # Only a member with ldapmailattrs including proxyAddresses
+    alternate = alternate_address(14)
+    # The first call syncs the old style storage, the others reuse it
+    password = mlist.getMemberPassword(hit)
+    saves = mlist.save_count
+    server.latency = 0
+
+    adaptor = mlist._memberadaptor
+    start = time.time()
+    adaptor.getRosterPage(None, 'number 123', 0, 30)
+    roster = time.time() - start
+
+    result = [
+        ('members', '%d' % len(members)),
+        ('refresh', '%.3f s' % refresh),
+        ('round trips', '%d' % roundtrips),
+        ('entries returned', '%d' % entries),
+        ('peak memory growth', '%d KB' % memory),
+        ('snapshot per member', '%d bytes' % (snapshot_size / max(len(members), 1))),
+        ('isMember hit', '%.2f us' % (harness.per_call(mlist.isMember, (hit,), mintime) * 1e6)),
+        ('isMember miss', '%.2f us' % (harness.per_call(mlist.isMember, (miss,), mintime) * 1e6)),
+        ('isMember alternate', '%.2f us' % (harness.per_call(mlist.isMember, (alternate,), mintime) * 1e6)),
+        ('getMembers', '%.2f us' % (harness.per_call(mlist.getMembers, (), mintime) * 1e6)),
+        ('getRegularMemberKeys', '%.2f us' % (harness.per_call(mlist.getRegularMemberKeys, (), mintime) * 1e6)),
+        ('getMemberCPAddress', '%.2f us' % (harness.per_call(mlist.getMemberCPAddress, (hit,), mintime) * 1e6)),
+        ('authenticateMember', '%.2f us' % (harness.per_call(mlist.authenticateMember, (hit, password), mintime) * 1e6)),
+        ('roster build', '%.3f s' % roster),
+        ('roster page', '%.2f us' % (harness.per_call(adaptor.getRosterPage, ('u', None, 30, 30), mintime) * 1e6)),
+        ('roster search', '%.2f us' % (harness.per_call(adaptor.getRosterPage, (None, 'number 123', 0, 30), mintime) * 1e6)),
+        ('admin page scan', '%.2f us' % (harness.per_call(admin_page, (mlist, 'number 123'), mintime) * 1e6)),
+        ('list locks / saves', '%d / %d' % (mlist.lock_count, mlist.save_count)),
+        ]
+    assert mlist.save_count == saves
+    for (label, value) in result:
+        print '%-22s %s' % (label, value)
+
+
+def usage(code, msg=''):
+    print >> sys.stderr, __doc__
+    if msg:
+        print >> sys.stderr, msg
+    sys.exit(code)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'm:o:t:l:', ['child'])
+    except getopt.error, msg:
+        usage(1, msg)
+    mode = 'search'
+    options = {}
+    mintime = 0.2
+    latency = 0.0
+    child = False
+    for (opt, arg) in opts:
+        if opt == '-m':
+            mode = arg
+        elif opt == '-o':
+            (name, value) = arg.split('=', 1)
+            options[name] = eval(value)
+        elif opt == '-t':
+            mintime = float(arg)
+        elif opt == '-l':
+            latency = float(arg)
+        elif opt == '--child':
+            child = True
+    sizes = [int(arg) for arg in args] or [1000, 10000]
+    if child:
+        run(sizes[0], mode, options, mintime, latency)
+        return
+    for size in sizes:
+        print '== %d entries, mode %s, options %r' % (size, mode, options)
+        sys.stdout.flush()
+        cmd = [sys.executable, os.path.abspath(__file__), '--child',
+               '-m', mode, '-t', str(mintime), '-l', str(latency)]
+        for (name, value) in options.items():
+            cmd.extend(['-o', '%s=%r' % (name, value)])
+        subprocess.call(cmd + [str(size)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+"""Startup benchmark for LDAP2Memberships.
+
+Measures what a CGI request or bin/ script pays before its first answer:
+importing the module, running extend(), and the first isMember.  Every
+run is a new process, like a CGI request.  The first run of each size
+starts cold and loads from LDAP, the second finds the snapshot file the
+first one wrote.
+
+Usage: python bench_startup.py [options] [size ...]
+
+    -m MODE         search, group, moderated or nested (default: search)
+    -o NAME=VALUE   set an adaptor option, e.g. -o ldapbatchsize=100;
+                    may be given several times
+    -l SECONDS      simulated network latency per LDAP operation
+
+Sizes default to 1000 10000.  ldapsnapshot is always set.
+"""
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run(size, mode, options, latency):
+    import harness
+    from harness import server, address
+
+    harness.populate(size)
+    server.latency = latency
+
+    start = time.time()
+    from Mailman import LDAP2Memberships as module
+    imported = time.time() - start
+
+    start = time.time()
+    mlist = harness.make_list('startup', mode, ldapsnapshot=True, **options)
+    extended = time.time() - start
+    loaded_by_extend = not isinstance(module.ldap, module._LazyLdap)
+
+    start = time.time()
+    # user0 is excluded from the staff group by its destinationindicator
+    assert mlist.isMember(address(2))
+    first = time.time() - start
+    loaded_by_ismember = not isinstance(module.ldap, module._LazyLdap)
+
+    result = [
+        ('import module', '%.2f ms' % (imported * 1e3)),
+        ('extend()', '%.2f ms' % (extended * 1e3)),
+        ('first isMember', '%.2f ms' % (first * 1e3)),
+        ('total', '%.2f ms' % ((imported + extended + first) * 1e3)),
+        ('round trips', '%d' % server.roundtrips()),
+        ('ldap imported by', loaded_by_extend and 'extend()'
+                             or loaded_by_ismember and 'isMember' or 'nothing'),
+        ]
+    for (label, value) in result:
+        print '%-22s %s' % (label, value)
+
+
+def usage(code, msg=''):
+    print >> sys.stderr, __doc__
+    if msg:
+        print >> sys.stderr, msg
+    sys.exit(code)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'm:o:l:', ['child'])
+    except getopt.error, msg:
+        usage(1, msg)
+    mode = 'search'
+    options = {}
+    latency = 0.0
+    child = False
+    for (opt, arg) in opts:
+        if opt == '-m':
+            mode = arg
+        elif opt == '-o':
+            (name, value) = arg.split('=', 1)
+            options[name] = eval(value)
+        elif opt == '-l':
+            latency = float(arg)
+        elif opt == '--child':
+            child = True
+    sizes = [int(arg) for arg in args] or [1000, 10000]
+    if child:
+        run(sizes[0], mode, options, latency)
+        return
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           '-m', mode, '-l', str(latency)]
+    for (name, value) in options.items():
+        cmd.extend(['-o', '%s=%r' % (name, value)])
+    env = dict(os.environ)
+    for size in sizes:
+        # The children share the list directory, and so the snapshot file
+        env['MAILMAN_LIST_DATA_DIR'] = tempfile.mkdtemp(prefix='bench_startup')
+        try:
+            for state in ('cold', 'warm snapshot'):
+                print '== %d entries, mode %s, options %r, %s' % (size, mode, options, state)
+                sys.stdout.flush()
+                subprocess.call(cmd + [str(size)], env=env)
+        finally:
+            shutil.rmtree(env['MAILMAN_LIST_DATA_DIR'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#! /usr/bin/env python
+"""Behaviour checks for LDAP2Memberships.
+
+Runs against the in-memory directory of harness.py like the benchmarks.
+
+Usage: python checks.py [name ...]
+
+Runs the named checks, all by default, and exits with status 1 if one of
+them fails.
+"""
+
+import sys
+import traceback
+
+import harness
+from harness import server, address, alternate_address, PEOPLE
+
+import ldap
+
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append(func)
+    return func
+
+
+def entry(i):
+    return server.entries[('uid=user%d,%s' % (i, PEOPLE)).lower()]
+
+
+@check
+def address_changes():
+    harness.populate(50, groupshare=1)
+    mlist = harness.make_list('changes', lock=1)
+    adaptor = mlist._memberadaptor
+
+    # user7 has a second mail value, which stays
+    assert not adaptor.changeMemberAddresses([(address(7), 'new7@example.net')])
+    assert entry(7)['mail'] == ['user7.alt@example.net', 'new7@example.net']
+    assert mlist.isMember('new7@example.net')
+    assert mlist.isMember('user7.alt@example.net')
+    assert not mlist.isMember(address(7))
+
+    # Same length and letters, a string modlist value would cancel out
+    assert not adaptor.changeMemberAddresses([(address(3), 'ab@x.org')])
+    assert not adaptor.changeMemberAddresses([('ab@x.org', 'ba@x.org')])
+    assert entry(3)['mail'] == ['ba@x.org']
+    assert mlist.getMemberCPAddress('ba@x.org') == 'ba@x.org'
+
+    # A failed change leaves the member as it was
+    server.delete('uid=user5,' + PEOPLE)
+    failed = adaptor.changeMemberAddresses([(address(5), 'five@example.net')])
+    assert isinstance(failed[address(5)], ldap.NO_SUCH_OBJECT)
+    assert mlist.isMember(address(5))
+    assert not mlist.isMember('five@example.net')
+    assert mlist.save_count == 3
+
+    # The connection is lost after the second modify was applied: the two
+    # without a result are sent again, and read back to confirm them
+    from Mailman.Logging.Syslog import syslog
+    del syslog.messages[:]
+    server.reset_stats()
+    server.dropafter = 2
+    assert not adaptor.changeMemberAddresses([(address(i), 'new%d@example.net' % i)
+                                              for i in (10, 11, 12)])
+    assert server.stats['modifies'] == 5, server.stats
+    assert [msg for (kind, msg) in syslog.messages if 'sending 2 ' in msg]
+    for i in (10, 11, 12):
+        assert entry(i)['mail'] == ['new%d@example.net' % i]
+        assert mlist.isMember('new%d@example.net' % i)
+    # Not sent again, the value really was there
+    failed = adaptor.changeMemberAddresses([('new7@example.net',
+                                             'user7.alt@example.net')])
+    assert isinstance(failed['new7@example.net'], ldap.TYPE_OR_VALUE_EXISTS)
+
+
+@check
+def incremental():
+    # The groups and teams are newer than every person
+    harness.populate(50)
+    mlist = harness.make_list('incremental', ldapincremental=True)
+    adaptor = mlist._memberadaptor
+    assert adaptor.ldapfullrefresh == 4 * adaptor.ldaprefresh
+
+    def refresh():
+        server.reset_stats()
+        adaptor.refresh()
+        return server.stats['searches']
+
+    assert len(mlist.getMembers()) == 50
+    assert refresh() == 1
+
+    # Added: the watermark search, the DNs and the changed entries
+    server.add('uid=new,' + PEOPLE, {'objectClass': ['inetOrgPerson'],
+                                     'uid': ['new'], 'mail': ['new@example.net']})
+    assert refresh() == 3
+    assert mlist.isMember('new@example.net')
+    # Changed
+    server.modify('uid=user3,' + PEOPLE,
+                  [(ldap.MOD_REPLACE, 'mail', ['three@example.net'])])
+    assert refresh() == 3
+    assert mlist.isMember('three@example.net')
+    assert not mlist.isMember(address(3))
+    # No longer matching ldapsearch
+    server.modify('uid=user4,' + PEOPLE,
+                  [(ldap.MOD_REPLACE, 'objectClass', ['account'])])
+    assert refresh() == 3
+    assert not mlist.isMember(address(4))
+    assert refresh() == 1
+    assert len(mlist.getMembers()) == 50
+
+    # Deleted: changes nothing the watermark sees, so waits for a change
+    server.delete('uid=user5,' + PEOPLE)
+    assert refresh() == 1
+    assert mlist.isMember(address(5))
+    # Renamed: deleted and added again with the same mail
+    server.delete('uid=user9,' + PEOPLE)
+    server.add('uid=user9b,' + PEOPLE, {'objectClass': ['inetOrgPerson'],
+                                        'uid': ['user9b'], 'mail': [address(9)]})
+    assert refresh() == 3
+    assert not mlist.isMember(address(5))
+    assert mlist.getMembers().count(address(9)) == 1
+    assert adaptor.getMemberKey(address(9)) == 'uid=user9b,' + PEOPLE
+    assert len(mlist.getMembers()) == 49
+
+    # A full reload agrees
+    before = sorted(mlist.getMembers())
+    adaptor.ldapfullrefresh = 0
+    refresh()
+    adaptor.ldapfullrefresh = 4 * adaptor.ldaprefresh
+    assert sorted(mlist.getMembers()) == before
+    assert refresh() == 1
+
+
+@check
+def abandoned_searches():
+    harness.populate(2000, groupshare=1)
+    server.filterlimit = 50
+    mlist = harness.make_list('batched', 'group', ldapbatchsize=100)
+    try:
+        mlist.getMembers()
+    except ldap.ADMINLIMIT_EXCEEDED:
+        pass
+    else:
+        raise AssertionError('no error')
+    l = mlist._memberadaptor._LDAP2Memberships__ldap_conn
+    assert l is not None and not l._pending, l._pending
+
+    server.filterlimit = 0
+    server.errors['uid=user1000,' + PEOPLE.lower()] = ldap.ADMINLIMIT_EXCEEDED({})
+    mlist = harness.make_list('walked', 'nested')
+    try:
+        mlist.getMembers()
+    except ldap.ADMINLIMIT_EXCEEDED:
+        pass
+    else:
+        raise AssertionError('no error')
+    l = mlist._memberadaptor._LDAP2Memberships__ldap_conn
+    assert l is not None and not l._pending, l._pending
+
+
+@check
+def chain_searches():
+    # team1 has 6000 direct members, more than one range of 1500
+    harness.populate(12000, teamsize=6000)
+    server.reset_stats()
+    mlist = harness.make_list('chain', 'nested', ldapnested='chain',
+                              ldapgroupdn='cn=team1,' + harness.GROUPS)
+    assert len(mlist.getMembers()) == 6000
+    # The group, its gidNumber and the chain search
+    assert server.stats['searches'] == 3, server.stats
+
+
+@check
+def failover():
+    from Mailman import LDAP2Memberships as module
+    harness.populate(20, groupshare=1)
+    servers = ('ldap://a.example.net', 'ldap://b.example.net')
+    mlist = harness.make_list('failover', ldapserver=' '.join(servers),
+                              ldaprefresh=0)
+    adaptor = mlist._memberadaptor
+    connection = lambda: adaptor._LDAP2Memberships__ldap_conn
+
+    assert len(mlist.getMembers()) == 20
+    assert connection().uri == servers[0]
+    for (down, up) in ((0, 1), (1, 0)):
+        server.down = set([servers[down]])
+        assert len(mlist.getMembers()) == 20
+        assert connection().uri == servers[up]
+        assert module._preferred_server[servers] == up
+    assert adaptor.stats()['refresh_failures'] == 0
+
+    # With every server down each is tried once, without a reconnect
+    from Mailman.Logging.Syslog import syslog
+    del syslog.messages[:]
+    mlist = harness.make_list('unreachable', ldapserver=' '.join(servers))
+    server.down = set(servers)
+    server.reset_stats()
+    try:
+        mlist.getMembers()
+    except ldap.SERVER_DOWN:
+        pass
+    else:
+        raise AssertionError('no error')
+    assert server.stats['connects'] == 2, server.stats
+    assert not [msg for (kind, msg) in syslog.messages if 'reconnecting' in msg]
+
+    # A pooled connection to a server that went away is closed, and the
+    # call repeated on a new one
+    pool = adaptor._LDAP2Memberships__ldap_pool()
+    call = adaptor._LDAP2Memberships__ldap_call_pooled
+    server.down = set()
+    first = call(lambda l: l)
+    assert first.uri == servers[0]
+    server.down = set([servers[0]])
+    second = call(lambda l: l.search_s(harness.BASEDN, ldap.SCOPE_BASE) and l)
+    assert second.uri == servers[1]
+    assert not first.bound
+    assert pool._ConnectionPool__idle == [second]
+    assert pool._ConnectionPool__slots._Semaphore__value == adaptor.ldappoolsize
+    server.down = set()
+
+    # An empty server list is a configuration error
+    mlist = harness.make_list('noserver', ldapserver=' ')
+    try:
+        mlist.getMembers()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('no error')
+
+
+@check
+def alternate_addresses():
+    harness.populate(50, groupshare=1)
+    options = {'ldapmailattrs': 'mailAlternateAddress proxyAddresses',
+               'ldapsnapshot': True}
+    mlist = harness.make_list('alternates', lock=1, **options)
+    adaptor = mlist._memberadaptor
+    dn = 'uid=user14,' + PEOPLE
+
+    assert not adaptor.changeMemberAddresses([(address(14), 'new14@example.net')])
+    for member in ('new14@example.net', 'u14@mail.example.net',
+                   alternate_address(14),
+                   # Still in proxyAddresses as SMTP:
+                   address(14)):
+        assert adaptor.getMemberKey(member) == dn, member
+
+    # Another process reads the snapshot file, and a reload agrees with it
+    other = harness.make_list('alternates', **options)
+    assert other.getMemberKey('u14@mail.example.net') == dn
+    before = sorted(mlist.getMembers())
+    adaptor.refresh(maxage=0)
+    assert sorted(mlist.getMembers()) == before
+    assert adaptor.getMemberKey(alternate_address(14)) == dn
+
+
+def main():
+    names = sys.argv[1:]
+    failures = 0
+    for func in CHECKS:
+        if names and func.__name__ not in names:
+            continue
+        try:
+            func()
+        except Exception:
+            failures += 1
+            print '%-24s FAILED' % func.__name__
+            traceback.print_exc()
+        else:
+            print '%-24s ok' % func.__name__
+    return failures and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
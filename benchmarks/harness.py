@@ -0,0 +1,198 @@
+#
+# Offline harness for LDAP2Memberships: an in-memory directory behind a
+# stand-in `ldap` module, a minimal `Mailman` package and synthetic data.
+#
+# Importing this module puts the stubs first on sys.path, so it has to be
+# imported before anything from Mailman or ldap.
+#
+
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'stubs'))
+
+import ldap
+from Mailman import MailList
+
+BASEDN = 'dc=example,dc=net'
+PEOPLE = 'ou=people,' + BASEDN
+GROUPS = 'ou=groups,' + BASEDN
+STAFF = 'cn=staff,' + GROUPS
+MODERATORS = 'cn=moderators,' + GROUPS
+EVERYONE = 'cn=everyone,' + GROUPS
+SERVER = 'ldap://ldap.example.net'
+GID = '500'
+
+server = ldap.server
+
+
+def populate(size, groupshare=0.5, modshare=0.01, excludeshare=0.001,
+             teamsize=1000):
+    """Fill the directory with size people and three groups.
+
+    Every seventh person has a second mail value, a mailAlternateAddress
+    and Active Directory style proxyAddresses.  groupshare of the people
+    are in the staff group and modshare in the moderators group;
+    excludeshare of the staff members carry a destinationindicator
+    excluding them from it.
+
+    The everyone group is built like in Active Directory: its member
+    values are the DNs of teams of teamsize people, the first team also
+    lists everyone, and the server returns at most 1500 values of an
+    attribute at once.
+    """
+    server.reset()
+    server.add(BASEDN, {'objectClass': ['domain']})
+    server.add(PEOPLE, {'objectClass': ['organizationalUnit']})
+    server.add(GROUPS, {'objectClass': ['organizationalUnit']})
+    staff = []
+    moderators = []
+    groupstep = groupshare and int(round(1 / groupshare)) or 0
+    modstep = modshare and int(round(1 / modshare)) or 0
+    excludestep = excludeshare and int(round(1 / excludeshare)) or 0
+    for i in xrange(size):
+        uid = 'user%d' % i
+        attrs = {'objectClass': ['inetOrgPerson', 'posixAccount'],
+                 'uid': [uid],
+                 'mail': ['User%d@Example.NET' % i],
+                 'displayName': ['User Number %d' % i]}
+        if i % 7 == 0:
+            attrs['mail'].append('user%d.alt@example.net' % i)
+            attrs['mailAlternateAddress'] = ['u%d@mail.example.net' % i]
+            attrs['proxyAddresses'] = ['SMTP:User%d@Example.NET' % i,
+                                       'smtp:' + alternate_address(i),
+                                       'X500:/o=Example/ou=people/cn=user%d' % i]
+        if groupstep and i % groupstep == 0:
+            staff.append(uid)
+            if excludestep and i % excludestep == 0:
+                attrs['destinationindicator'] = ['100,%s' % GID]
+        if modstep and i % modstep == 0:
+            moderators.append(uid)
+        server.add('uid=%s,%s' % (uid, PEOPLE), attrs)
+    server.add(STAFF, {'objectClass': ['posixGroup'], 'cn': ['staff'],
+                       'gidNumber': [GID], 'memberUid': staff})
+    server.add(MODERATORS, {'objectClass': ['posixGroup'], 'cn': ['moderators'],
+                            'gidNumber': ['501'], 'memberUid': moderators})
+    teams = []
+    for start in xrange(0, size, teamsize):
+        team = 'cn=team%d,%s' % (len(teams), GROUPS)
+        members = ['uid=user%d,%s' % (i, PEOPLE)
+                   for i in xrange(start, min(start + teamsize, size))]
+        if not teams:
+            members.append(EVERYONE)
+        server.add(team, {'objectClass': ['group'], 'member': members})
+        teams.append(team)
+    server.add(EVERYONE, {'objectClass': ['group'], 'gidNumber': ['502'],
+                          'member': teams})
+    server.rangelimit = 1500
+    server.reset_stats()
+
+
+def address(i):
+    return 'user%d@example.net' % i
+
+
+def alternate_address(i):
+    """A proxyAddresses address of every seventh person"""
+    return 'U%d@Corp.Example.NET' % i
+
+
+def make_list(name='bench', mode='search', lock=0, **options):
+    """Return a MailList using LDAP2Memberships.
+
+    mode is 'search' (all people), 'group' (the staff group), 'moderated'
+    (the staff group plus the moderators group) or 'nested' (the everyone
+    group, with ldapnested set to 'walk').  options are set on the adaptor
+    before defaults() is called, like extend.py does.
+    """
+    from Mailman.LDAP2Memberships import LDAP2Memberships
+
+    def extend(mlist):
+        adaptor = LDAP2Memberships(mlist)
+        adaptor.ldapserver = SERVER
+        adaptor.ldapbasedn = BASEDN
+        adaptor.ldapbinddn = 'cn=admin,' + BASEDN
+        adaptor.ldappasswd = ''
+        adaptor.ldaprefresh = 300
+        adaptor.ldaptls = False
+        adaptor.ldapfullname = 'displayName'
+        if mode == 'search':
+            adaptor.ldapsearch = '(objectClass=inetOrgPerson)'
+            adaptor.ldapgroupdn = None
+            adaptor.ldapgroupattr = None
+        elif mode == 'nested':
+            adaptor.ldapsearch = '(objectClass=group)'
+            adaptor.ldapgroupdn = EVERYONE
+            adaptor.ldapgroupattr = 'member'
+            adaptor.ldapmemberuid = 'distinguishedName'
+            adaptor.ldapnested = 'walk'
+        else:
+            adaptor.ldapsearch = '(objectClass=posixGroup)'
+            adaptor.ldapgroupdn = STAFF
+            adaptor.ldapgroupattr = 'memberUid'
+            if mode == 'moderated':
+                adaptor.ldapmodgroupdn = MODERATORS
+        for (key, value) in options.items():
+            setattr(adaptor, key, value)
+        adaptor.defaults()
+        mlist._memberadaptor = adaptor
+    return MailList.MailList(name, lock=lock, extend=extend)
+
+
+def rss():
+    """Current resident set size in KB (Linux), else the peak"""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def deep_size(obj, seen=None):
+    """Bytes of obj and the objects it holds, each object counted once.
+
+    Instances are followed through their __dict__, containers through
+    their items; other objects are counted but not followed.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+    return size
+
+
+def per_call(func, args=(), mintime=0.2):
+    """Average seconds per call of func(*args), over at least mintime"""
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    batch = 1
+    while elapsed < mintime:
+        for i in xrange(batch):
+            func(*args)
+        calls += batch
+        batch *= 2
+        elapsed = time.time() - start
+    return elapsed / calls
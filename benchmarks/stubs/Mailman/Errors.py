@@ -0,0 +1,26 @@
+class MailmanError(Exception):
+    pass
+
+class MMListError(MailmanError):
+    pass
+
+class MMUnknownListError(MMListError):
+    pass
+
+class MemberError(MailmanError):
+    pass
+
+class NotAMemberError(MemberError):
+    pass
+
+class AlreadyReceivingDigests(MemberError):
+    pass
+
+class AlreadyReceivingRegularDeliveries(MemberError):
+    pass
+
+class CantDigestError(MemberError):
+    pass
+
+class MustDigestError(MemberError):
+    pass
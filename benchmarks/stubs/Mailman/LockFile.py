@@ -0,0 +1,50 @@
+import os
+import time
+
+
+class LockError(Exception):
+    pass
+
+class AlreadyLockedError(LockError):
+    pass
+
+class NotLockedError(LockError):
+    pass
+
+class TimeOutError(LockError):
+    pass
+
+
+class LockFile:
+    """Single-process stand-in for Mailman's NFS-safe lock"""
+
+    def __init__(self, lockfile, lifetime=15, withlogging=False):
+        self.__lockfile = lockfile
+        self.__owned = False
+
+    def lock(self, timeout=0):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fd = os.open(self.__lockfile,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                self.__owned = True
+                return
+            except OSError:
+                if timeout and time.time() < deadline:
+                    time.sleep(0.01)
+                    continue
+                raise TimeOutError(self.__lockfile)
+
+    def unlock(self, unconditionally=False):
+        if not self.__owned and not unconditionally:
+            raise NotLockedError(self.__lockfile)
+        try:
+            os.unlink(self.__lockfile)
+        except OSError:
+            pass
+        self.__owned = False
+
+    def locked(self):
+        return self.__owned
@@ -0,0 +1,13 @@
+class _Syslog:
+    def __init__(self):
+        self.messages = []
+        self.echo = False
+
+    def __call__(self, kind, msg, *args, **kws):
+        if args:
+            msg = msg % args
+        self.messages.append((kind, msg))
+        if self.echo:
+            print '%s: %s' % (kind, msg)
+
+syslog = _Syslog()
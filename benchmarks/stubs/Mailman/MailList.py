@@ -0,0 +1,69 @@
+"""A MailList stand-in with lock and Save() counters"""
+
+import os
+
+from Mailman import mm_cfg
+
+
+class MailList:
+    def __init__(self, listname='test', lock=1, extend=None):
+        self._internal_name = listname
+        self.members = {}
+        self.digest_members = {}
+        self.passwords = {}
+        self.user_options = {}
+        self.language = {}
+        self.topics_userinterest = {}
+        self.bounce_info = {}
+        self.delivery_status = {}
+        self.one_last_digest = {}
+        self.digestable = True
+        self.nondigestable = True
+        self.new_member_options = 256
+        self.preferred_language = 'en'
+        self.default_member_moderation = True
+        self.bounce_processing = True
+        self.lock_count = 0
+        self.save_count = 0
+        self._locked = False
+        self._fullpath = os.path.join(mm_cfg.LIST_DATA_DIR, listname.lower())
+        if not os.path.isdir(self._fullpath):
+            os.makedirs(self._fullpath)
+        if extend is not None:
+            extend(self)
+        elif os.path.exists(os.path.join(self._fullpath, 'extend.py')):
+            d = {}
+            execfile(os.path.join(self._fullpath, 'extend.py'), d)
+            d['extend'](self)
+        if lock:
+            self.Lock()
+
+    def internal_name(self):
+        return self._internal_name
+
+    def fullpath(self):
+        return self._fullpath
+
+    def Lock(self, timeout=0):
+        assert not self._locked
+        self.lock_count += 1
+        self._locked = True
+
+    def Unlock(self):
+        self._locked = False
+
+    def Locked(self):
+        return self._locked
+
+    def Save(self):
+        assert self._locked
+        self.save_count += 1
+
+    def GetAvailableLanguages(self):
+        return ['en', 'de']
+
+    def __getattr__(self, name):
+        # Delegate membership calls to the adaptor like Mailman does
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.__dict__['_memberadaptor'], name)
@@ -0,0 +1,9 @@
+ENABLED = 0
+UNKNOWN = 1
+BYUSER = 2
+BYADMIN = 3
+BYBOUNCE = 4
+
+
+class MemberAdaptor:
+    pass
@@ -0,0 +1,11 @@
+import os
+import random
+
+from Mailman import mm_cfg
+
+def MakeRandomPassword(length=8):
+    return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz')
+                   for i in range(length))
+
+def list_names():
+    return sorted(os.listdir(mm_cfg.LIST_DATA_DIR))
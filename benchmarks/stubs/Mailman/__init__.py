@@ -0,0 +1,8 @@
+"""Minimal stand-in for the Mailman 2.1 package.
+
+The repository root is appended to the package path so that
+`Mailman.LDAP2Memberships` resolves to the module under development.
+"""
+import os
+__path__.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))))
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# Shared by processes started with the same MAILMAN_LIST_DATA_DIR
+LIST_DATA_DIR = (os.environ.get('MAILMAN_LIST_DATA_DIR')
+                 or tempfile.mkdtemp(prefix='mailman-lists-'))
+
+Digests = 0
+DisableDelivery = 1
+DontReceiveOwnPosts = 2
+AcknowledgePosts = 4
+DisableMime = 8
+ConcealSubscription = 16
+SuppressPasswordReminder = 32
+ReceiveNonmatchingTopics = 64
+Moderate = 128
+DontReceiveDuplicates = 256
@@ -0,0 +1,517 @@
+"""In-memory stand-in for the parts of python-ldap used by LDAP2Memberships.
+
+A single module-level `server` holds the directory.  Every call that would
+be a network round trip on a real connection is counted in `server.stats`.
+"""
+
+import itertools
+import threading
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+
+RES_SEARCH_ENTRY = 100
+RES_SEARCH_RESULT = 101
+RES_MODIFY = 103
+
+OPT_NETWORK_TIMEOUT = 0x5005
+OPT_TIMEOUT = 0x5002
+OPT_REFERRALS = 0x0008
+OPT_PROTOCOL_VERSION = 0x0011
+
+
+class LDAPError(Exception):
+    pass
+
+class SERVER_DOWN(LDAPError):
+    pass
+
+class NO_SUCH_OBJECT(LDAPError):
+    pass
+
+class NO_SUCH_ATTRIBUTE(LDAPError):
+    pass
+
+class TYPE_OR_VALUE_EXISTS(LDAPError):
+    pass
+
+class SIZELIMIT_EXCEEDED(LDAPError):
+    pass
+
+class ADMINLIMIT_EXCEEDED(LDAPError):
+    pass
+
+class TIMEOUT(LDAPError):
+    pass
+
+class INVALID_CREDENTIALS(LDAPError):
+    pass
+
+class FILTER_ERROR(LDAPError):
+    pass
+
+
+#
+# Filter evaluation (RFC 4515 subset)
+#
+def _unescape(value):
+    out = []
+    i = 0
+    while i < len(value):
+        if value[i] == '\\' and i + 2 < len(value) + 1:
+            out.append(chr(int(value[i+1:i+3], 16)))
+            i += 3
+        else:
+            out.append(value[i])
+            i += 1
+    return ''.join(out)
+
+def _parse(s, i=0):
+    if s[i] != '(':
+        raise FILTER_ERROR(s)
+    i += 1
+    op = s[i]
+    if op in '&|':
+        i += 1
+        subs = []
+        while s[i] == '(':
+            node, i = _parse(s, i)
+            subs.append(node)
+        return (op, subs), i + 1
+    if op == '!':
+        node, i = _parse(s, i + 1)
+        return ('!', node), i + 1
+    end = s.index(')', i)
+    item = s[i:end]
+    for cmp in ('>=', '<=', '~=', ':=', '='):
+        pos = item.find(cmp)
+        if pos > 0:
+            attr, value = item[:pos], item[pos+len(cmp):]
+            break
+    else:
+        raise FILTER_ERROR(s)
+    if cmp == ':=':
+        attr, rule = attr.split(':', 1)
+        return ('ext', attr, rule.strip(':'), _unescape(value)), end + 1
+    if cmp == '=' and value == '*':
+        return ('present', attr), end + 1
+    if cmp == '=' and '*' in value:
+        return ('sub', attr, [_unescape(p).lower() for p in value.split('*')]), end + 1
+    return (cmp, attr, _unescape(value)), end + 1
+
+_filter_cache = {}
+
+def parse_filter(s):
+    node = _filter_cache.get(s)
+    if node is None:
+        s = s.strip()
+        if not s.startswith('('):
+            s = '(' + s + ')'
+        node, _ = _parse(s)
+        _filter_cache[s] = node
+    return node
+
+def _values(entry, attr):
+    attr = attr.lower()
+    for k, v in entry.items():
+        if k.lower() == attr:
+            return v
+    if attr == 'distinguishedname':
+        return [entry['__dn__']]
+    return []
+
+def _match(node, entry):
+    op = node[0]
+    if op == '&':
+        for n in node[1]:
+            if not _match(n, entry):
+                return False
+        return True
+    if op == '|':
+        for n in node[1]:
+            if _match(n, entry):
+                return True
+        return False
+    if op == '!':
+        return not _match(node[1], entry)
+    if op == 'present':
+        return node[1].lower() == 'objectclass' or bool(_values(entry, node[1]))
+    values = _values(entry, node[1])
+    if op == 'sub':
+        parts = node[2]
+        for v in values:
+            v = v.lower()
+            if not v.startswith(parts[0]) or not v.endswith(parts[-1]):
+                continue
+            pos = len(parts[0])
+            ok = True
+            for p in parts[1:-1]:
+                pos = v.find(p, pos)
+                if pos < 0:
+                    ok = False
+                    break
+                pos += len(p)
+            if ok and pos <= len(v) - len(parts[-1]):
+                return True
+        return False
+    target = node[2].lower()
+    if op in ('=', '~='):
+        for v in values:
+            if v.lower() == target:
+                return True
+        return False
+    if op in ('>=', '<='):
+        for v in values:
+            a, b = v.lower(), target
+            if a.isdigit() and b.isdigit():
+                a, b = int(a), int(b)
+            if (op == '>=' and a >= b) or (op == '<=' and a <= b):
+                return True
+        return False
+    if op == 'ext':
+        # LDAP_MATCHING_RULE_IN_CHAIN on memberOf
+        if node[2] == '1.2.840.113556.1.4.1941':
+            return server.in_chain(entry['__dn__'], node[3])
+        return False
+    raise FILTER_ERROR(node)
+
+
+class Directory(object):
+    """The directory contents plus round-trip counters"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.entries = {}
+        # (attribute, value) -> keys of the entries, both lowercased
+        self.index = {}
+        self.seq = itertools.count()
+        self.down = set()
+        self.sizelimit = 0
+        # Filters with more terms fail with ADMINLIMIT_EXCEEDED
+        self.filterlimit = 0
+        # Lowercased base DN -> error raised by searches of it
+        self.errors = {}
+        self.rangelimit = 0
+        self.latency = 0.0
+        # The connection sending modify number dropafter is lost once that
+        # modify has been applied, before its result is read
+        self.dropafter = 0
+        self.clock = itertools.count(1)
+        # group dn -> dns of its direct and nested members, all lowercased
+        self.chains = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'connects': 0, 'binds': 0, 'searches': 0,
+                      'entries': 0, 'modifies': 0}
+
+    def roundtrips(self):
+        return (self.stats['binds'] + self.stats['searches']
+                + self.stats['modifies'])
+
+    def timestamp(self):
+        return '20260101%06dZ' % next(self.clock)
+
+    def _index(self, key, entry, add):
+        for (attr, values) in entry.items():
+            if attr.startswith('__'):
+                continue
+            for value in values:
+                ikey = (attr.lower(), value.lower())
+                if add:
+                    self.index.setdefault(ikey, set()).add(key)
+                else:
+                    self.index.get(ikey, set()).discard(key)
+
+    def add(self, dn, attrs):
+        entry = dict((k, list(v)) for k, v in attrs.items())
+        entry['__dn__'] = dn
+        entry.setdefault('modifyTimestamp', [self.timestamp()])
+        key = dn.lower()
+        if key in self.entries:
+            self._index(key, self.entries[key], False)
+            entry['__seq__'] = self.entries[key]['__seq__']
+        else:
+            entry['__seq__'] = next(self.seq)
+        self.entries[key] = entry
+        self._index(key, entry, True)
+        self.chains.clear()
+
+    def delete(self, dn):
+        key = dn.lower()
+        self._index(key, self.entries.pop(key), False)
+        self.chains.clear()
+
+    def modify(self, dn, modlist):
+        key = dn.lower()
+        entry = self.entries.get(key)
+        if entry is None:
+            raise NO_SUCH_OBJECT({'desc': 'No such object', 'matched': dn})
+        # Values are compared ignoring case, like mail and uid on a server
+        for (op, attr, value) in modlist:
+            if op == MOD_DELETE and value is not None:
+                present = [v.lower() for v in entry.get(attr, [])]
+                if isinstance(value, str):
+                    value = [value]
+                for v in value:
+                    if v.lower() not in present:
+                        raise NO_SUCH_ATTRIBUTE({'desc': 'No such attribute',
+                                                 'info': '%s: %s' % (attr, v)})
+        for (op, attr, value) in modlist:
+            if op == MOD_ADD:
+                present = [v.lower() for v in entry.get(attr, [])]
+                if isinstance(value, str):
+                    value = [value]
+                for v in value:
+                    if v.lower() in present:
+                        raise TYPE_OR_VALUE_EXISTS({'desc': 'Type or value exists',
+                                                    'info': '%s: %s' % (attr, v)})
+        self._index(key, entry, False)
+        for (op, attr, value) in modlist:
+            if isinstance(value, str):
+                value = [value]
+            if op == MOD_DELETE:
+                if value is None:
+                    entry.pop(attr, None)
+                else:
+                    value = [v.lower() for v in value]
+                    entry[attr] = [v for v in entry.get(attr, [])
+                                   if v.lower() not in value]
+            elif op == MOD_ADD:
+                entry.setdefault(attr, []).extend(value)
+            else:
+                entry[attr] = list(value)
+        entry['modifyTimestamp'] = [self.timestamp()]
+        self._index(key, entry, True)
+        self.chains.clear()
+
+    def chain(self, groupdn):
+        groupdn = groupdn.lower()
+        members = self.chains.get(groupdn)
+        if members is not None:
+            return members
+        members = set()
+        seen = set()
+        todo = [groupdn]
+        while todo:
+            g = todo.pop()
+            if g in seen:
+                continue
+            seen.add(g)
+            entry = self.entries.get(g)
+            if entry is None:
+                continue
+            for m in entry.get('member', []):
+                members.add(m.lower())
+                todo.append(m.lower())
+        self.chains[groupdn] = members
+        return members
+
+    def in_chain(self, dn, groupdn):
+        return dn.lower() in self.chain(groupdn)
+
+    def _candidates(self, node):
+        """Keys that may match node, or None for all entries"""
+        if node[0] == '=':
+            return self.index.get((node[1].lower(), node[2].lower()), set())
+        if node[0] == 'ext' and node[2] == '1.2.840.113556.1.4.1941':
+            return self.chain(node[3]) & set(self.entries)
+        if node[0] == '&':
+            for sub in node[1]:
+                keys = self._candidates(sub)
+                if keys is not None:
+                    return keys
+            return None
+        if node[0] == '|':
+            keys = set()
+            for sub in node[1]:
+                subkeys = self._candidates(sub)
+                if subkeys is None:
+                    return None
+                keys |= subkeys
+            return keys
+        return None
+
+    def search(self, base, scope, filterstr, attrlist):
+        if self.filterlimit and (filterstr or '').count('(') > self.filterlimit:
+            raise ADMINLIMIT_EXCEEDED({'desc': 'Administrative limit exceeded'})
+        node = parse_filter(filterstr or '(objectClass=*)')
+        base = base.lower()
+        if base in self.errors:
+            raise self.errors[base]
+        if base and base not in self.entries:
+            raise NO_SUCH_OBJECT({'desc': 'No such object', 'matched': base})
+        if scope == SCOPE_BASE:
+            keys = [base]
+        else:
+            keys = self._candidates(node)
+            if keys is None:
+                keys = self.entries.keys()
+        entries = [self.entries[key] for key in keys]
+        entries.sort(key=lambda entry: entry['__seq__'])
+        result = []
+        for entry in entries:
+            key = entry['__dn__'].lower()
+            if scope == SCOPE_ONELEVEL:
+                if not key.endswith(',' + base) or ',' in key[:-len(base)-1]:
+                    continue
+            elif (scope == SCOPE_SUBTREE and base and key != base
+                  and not key.endswith(',' + base)):
+                continue
+            if _match(node, entry):
+                result.append((entry['__dn__'], self.project(entry, attrlist)))
+        return result
+
+    def project(self, entry, attrlist):
+        if attrlist == ['1.1']:
+            return {}
+        out = {}
+        if attrlist is None or '*' in attrlist:
+            wanted = [k for k in entry if not k.startswith('__')]
+        else:
+            wanted = attrlist
+        for want in wanted:
+            name, _, rng = want.partition(';range=')
+            for k, v in entry.items():
+                if k.lower() != name.lower() or k.startswith('__'):
+                    continue
+                limit = self.rangelimit
+                if rng or (limit and len(v) > limit):
+                    lo = int(rng.split('-')[0]) if rng else 0
+                    hi = lo + (limit or len(v)) - 1
+                    if hi >= len(v) - 1:
+                        out['%s;range=%d-*' % (k, lo)] = v[lo:]
+                    else:
+                        out['%s;range=%d-%d' % (k, lo, hi)] = v[lo:hi+1]
+                else:
+                    out[k] = list(v)
+        return out
+
+server = Directory()
+
+
+class LDAPObject(object):
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.options = {}
+        self.bound = False
+        self._msgid = itertools.count(1)
+        self._pending = {}
+        self.dropped = False
+        server.stats['connects'] += 1
+
+    def _check(self):
+        if self.dropped or self.uri in server.down:
+            raise SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        if server.latency:
+            import time
+            time.sleep(server.latency)
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def start_tls_s(self):
+        self._check()
+
+    def simple_bind_s(self, who='', cred=''):
+        self._check()
+        server.stats['binds'] += 1
+        self.bound = True
+
+    def unbind_s(self):
+        self.bound = False
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                 attrsonly=0):
+        self._check()
+        with server.lock:
+            server.stats['searches'] += 1
+            result = server.search(base, scope, filterstr, attrlist)
+            if server.sizelimit and len(result) > server.sizelimit:
+                raise SIZELIMIT_EXCEEDED({'desc': 'Size limit exceeded'})
+            server.stats['entries'] += len(result)
+        return result
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        self._check()
+        msgid = next(self._msgid)
+        with server.lock:
+            server.stats['searches'] += 1
+            try:
+                result = server.search(base, scope, filterstr, attrlist)
+            except LDAPError, e:
+                self._pending[msgid] = e
+                return msgid
+            ctrls = []
+            for ctrl in serverctrls or ():
+                if isinstance(ctrl, controls.SimplePagedResultsControl):
+                    start = int(ctrl.cookie or 0)
+                    end = start + ctrl.size
+                    page = result[start:end]
+                    cookie = end < len(result) and str(end) or ''
+                    ctrls.append(controls.SimplePagedResultsControl(
+                        False, size=len(result), cookie=cookie))
+                    result = page
+            if (not ctrls and server.sizelimit
+                    and len(result) > server.sizelimit):
+                self._pending[msgid] = SIZELIMIT_EXCEEDED(
+                    {'desc': 'Size limit exceeded'})
+                return msgid
+            server.stats['entries'] += len(result)
+        self._pending[msgid] = (RES_SEARCH_RESULT, result, msgid, ctrls)
+        return msgid
+
+    def modify_s(self, dn, modlist):
+        self._check()
+        with server.lock:
+            server.stats['modifies'] += 1
+            server.modify(dn, modlist)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        self._check()
+        msgid = next(self._msgid)
+        with server.lock:
+            server.stats['modifies'] += 1
+            try:
+                server.modify(dn, modlist)
+                self._pending[msgid] = (RES_MODIFY, [], msgid, [])
+            except LDAPError, e:
+                self._pending[msgid] = e
+            if server.dropafter and server.stats['modifies'] >= server.dropafter:
+                server.dropafter = 0
+                self.dropped = True
+        return msgid
+
+    def result3(self, msgid=-1, all=1, timeout=None):
+        if self.dropped:
+            raise SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        res = self._pending.pop(msgid)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def result(self, msgid=-1, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:2]
+
+    def abandon(self, msgid):
+        self._pending.pop(msgid, None)
+
+
+def initialize(uri, trace_level=0):
+    return LDAPObject(uri)
+
+def set_option(option, value):
+    pass
+
+import controls, filter, modlist
@@ -0,0 +1,10 @@
+class RequestControl(object):
+    pass
+
+class SimplePagedResultsControl(RequestControl):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality=True, size=10, cookie=''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
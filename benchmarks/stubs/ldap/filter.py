@@ -0,0 +1,7 @@
+def escape_filter_chars(assertion_value, escape_mode=0):
+    s = assertion_value.replace('\\', r'\5c')
+    s = s.replace('*', r'\2a')
+    s = s.replace('(', r'\28')
+    s = s.replace(')', r'\29')
+    s = s.replace('\x00', r'\00')
+    return s
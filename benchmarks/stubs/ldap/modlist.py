@@ -0,0 +1,12 @@
+import ldap
+
+def modifyModlist(old_entry, new_entry, ignore_attr_types=None,
+                  ignore_oldexistent=0, case_ignore_attr_types=None):
+    modlist = []
+    for attr, new in new_entry.items():
+        old = old_entry.get(attr)
+        if old != new:
+            if old is not None:
+                modlist.append((ldap.MOD_DELETE, attr, None))
+            modlist.append((ldap.MOD_ADD, attr, new))
+    return modlist